@@ -1,23 +1,44 @@
-# ashik.py  — FAST version, Cloudinary-backed encodings JSON, GROUP support
+# ashik.py  — FAST version, Cloudinary-synced encodings, GROUP support
 import os
 import io
+import sys
 import json
 import time
+import random
+import bisect
+import logging
 import qrcode
+import queue
+import struct
 import threading
+import multiprocessing
+import uuid
+import hashlib
+import zipfile
 import requests
+from collections import OrderedDict
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 import face_recognition
 import numpy as np
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 from flask import (
     Flask, render_template, request, redirect, url_for, flash, session,
-    jsonify, send_file, Response, stream_with_context, send_from_directory
+    jsonify, send_file, Response, stream_with_context, send_from_directory, g, has_request_context
 )
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl  # POSIX only; store locking is per-process without it
+except ImportError:
+    fcntl = None
 
 # -------------------- CONFIG --------------------
 load_dotenv()
@@ -33,7 +54,7 @@ cloudinary.config(
 )
 
 # -------------------- PATHS & SETTINGS --------------------
-ENCODINGS_DIR = "encodings"
+ENCODINGS_DIR = os.getenv("ENCODINGS_DIR", "encodings")
 UPLOADS_DIR = "uploads"
 QR_DIR = os.path.join("static", "qr_codes")
 
@@ -41,6 +62,52 @@ os.makedirs(ENCODINGS_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(QR_DIR, exist_ok=True)
 
+ENCODINGS_CACHE_MB = float(os.getenv("ENCODINGS_CACHE_MB", "256"))
+
+# Ingest pipeline: download threads -> bounded queue -> encode processes
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", str(os.cpu_count() or 1)))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+
+# Selfie matching: decoded in memory, encoded on a bounded pool; requests
+# beyond SELFIE_WORKERS running + SELFIE_QUEUE waiting get "busy, retry"
+SELFIE_MAX_DIM = int(os.getenv("SELFIE_MAX_DIM", "1024"))
+SELFIE_WORKERS = int(os.getenv("SELFIE_WORKERS", str(os.cpu_count() or 1)))
+SELFIE_QUEUE = int(os.getenv("SELFIE_QUEUE", "8"))
+SELFIE_RETRY_AFTER = int(os.getenv("SELFIE_RETRY_AFTER", "3"))
+
+# Photographer uploads: resized to UPLOAD_MAX_DIM, pushed to Cloudinary in parallel
+UPLOAD_MAX_DIM = int(os.getenv("UPLOAD_MAX_DIM", "2048"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+
+# Image download proxy: on-disk LRU cache of fetched originals
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "images"))
+IMAGE_CACHE_MB = float(os.getenv("IMAGE_CACHE_MB", "1024"))
+DOWNLOAD_CHUNK = 64 * 1024
+# only these hosts are proxied (and cached)
+DOWNLOAD_HOSTS = set(os.getenv("DOWNLOAD_HOSTS", "res.cloudinary.com").split(","))
+
+# Selfie results: kept server-side (session only holds the id)
+RESULTS_DIR = os.getenv("RESULTS_DIR", "results")
+RESULTS_TTL_SECONDS = int(os.getenv("RESULTS_TTL_SECONDS", str(6 * 3600)))
+RESULTS_PAGE_SIZE = 24
+THUMB_TRANSFORM = os.getenv("THUMB_TRANSFORM", "c_fill,g_faces,w_400,h_400,q_auto,f_auto")
+
+# Encodings sync: "cloudinary" or "local:<dir>" (stand-in for tests/benchmarks)
+ENCODINGS_REMOTE = os.getenv("ENCODINGS_REMOTE", "cloudinary")
+SYNC_POLL_SECONDS = float(os.getenv("SYNC_POLL_SECONDS", "60"))
+SYNC_COMPACT_SHARDS = int(os.getenv("SYNC_COMPACT_SHARDS", "20"))
+
+# Background encoding jobs: requests for the same event within this window coalesce
+ENCODE_DEBOUNCE_SECONDS = float(os.getenv("ENCODE_DEBOUNCE_SECONDS", "3"))
+
+# Serving: gunicorn.conf.py sets SMARTPIX_PRELOAD=1 and imports the app once
+# in the master; background threads then start per worker after the fork.
+# PRELOAD_EVENTS are loaded in the master and shared copy-on-write.
+PRELOADED = os.getenv("SMARTPIX_PRELOAD") == "1"
+PRELOAD_EVENTS = [e.strip() for e in os.getenv("PRELOAD_EVENTS", "").split(",") if e.strip()]
+
 BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:5000")
 STUDIO_LOGO_NAME = os.getenv("STUDIO_LOGO_NAME", "studio_logo")
 
@@ -52,168 +119,2336 @@ PHOTOGRAPHER_CREDENTIALS = {
     "rasin": {"password": "0987", "event": "event_D"}
 }
 
+# Face detection profiles. Faces are located on a copy downscaled to
+# detect_max_dim (None = full size) and encoded on the original image.
+# model "cnn" is only practical with a CUDA build of dlib.
+DETECTION_PROFILES = {
+    "fast": {"detect_max_dim": 640, "upsample": 0, "model": "hog", "num_jitters": 1},
+    "balanced": {"detect_max_dim": 1024, "upsample": 1, "model": "hog", "num_jitters": 1},
+    "accurate": {"detect_max_dim": None, "upsample": 1, "model": "hog", "num_jitters": 2},
+}
+
+# Match settings (defaults, overridable per event in EVENT_SETTINGS)
+DEFAULT_EVENT_SETTINGS = {
+    "tolerance": float(os.getenv("MATCH_TOLERANCE", "0.55")),
+    "top_k": int(os.getenv("MATCH_TOP_K", "0")),  # 0 = return every match
+    "selfie_profile": os.getenv("SELFIE_PROFILE", "fast"),
+    "ingest_profile": os.getenv("INGEST_PROFILE", "balanced"),
+    # approximate search (IVF) for events with at least this many faces
+    "ann_min_faces": int(os.getenv("ANN_MIN_FACES", "50000")),
+    "ann_nprobe": int(os.getenv("ANN_NPROBE", "8")),
+    # person clusters: selfies are compared with cluster centroids first;
+    # when on they replace the IVF index, which is then neither kept nor used
+    "clusters": os.getenv("PERSON_CLUSTERS", "1") == "1",
+    "cluster_radius": float(os.getenv("CLUSTER_RADIUS", "0.4")),
+    "cluster_margin": float(os.getenv("CLUSTER_MARGIN", "0.1")),
+    "cluster_refine": os.getenv("CLUSTER_REFINE", "1") == "1",
+}
+EVENT_SETTINGS = {
+    # "event_A": {"tolerance": 0.5, "top_k": 300, "ingest_profile": "accurate"},
+}
+
+def event_settings(event):
+    settings = dict(DEFAULT_EVENT_SETTINGS)
+    settings.update(EVENT_SETTINGS.get(event, {}))
+    return settings
+
+# Shared HTTP session: keep-alive pool, retries on transient errors
+HTTP = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(DOWNLOAD_WORKERS, 10),
+    max_retries=Retry(
+        total=DOWNLOAD_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD")
+    )
+)
+HTTP.mount("https://", _http_adapter)
+HTTP.mount("http://", _http_adapter)
+
+# -------------------- LOGGING & METRICS --------------------
+# Logs: one "<what> key=value ..." line per event on the "smartpix" logger.
+# Metrics are kept per process and served on /metrics in Prometheus text
+# format (under gunicorn each worker reports its own).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# slow-request traces: a TRACE_SAMPLE_RATE fraction of requests slower than
+# SLOW_TRACE_MS log their per-stage timings (0 = off)
+SLOW_TRACE_MS = float(os.getenv("SLOW_TRACE_MS", "0"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+log = logging.getLogger("smartpix")
+
+def _log_value(value):
+    if isinstance(value, float):
+        value = round(value, 4)
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+def log_kv(msg, level=logging.INFO, **fields):
+    """Log msg followed by key=value pairs (None values are left out)."""
+    if not log.isEnabledFor(level):
+        return
+    pairs = " ".join(f"{k}={_log_value(v)}" for k, v in fields.items() if v is not None)
+    log.log(level, "%s", f"{msg} {pairs}" if pairs else msg)
+
+METRICS_HELP = {
+    "smartpix_requests_total": ("counter", "HTTP requests by endpoint and status."),
+    "smartpix_request_seconds": ("histogram", "HTTP request latency by endpoint, until the response starts."),
+    "smartpix_stage_seconds": ("histogram", "Latency of one processing stage, by stage and event."),
+    "smartpix_errors_total": ("counter", "Errors by stage and event."),
+    "smartpix_cloudinary_calls_total": ("counter", "Cloudinary API and CDN calls by operation."),
+    "smartpix_cloudinary_errors_total": ("counter", "Failed Cloudinary API and CDN calls by operation."),
+    "smartpix_cloudinary_seconds": ("histogram", "Cloudinary call latency by operation."),
+    "smartpix_faces_added_total": ("counter", "Face encodings added to the local store, by event and source."),
+    "smartpix_photos_total": ("counter", "Photos uploaded or reconciled, by event, source and outcome."),
+    "smartpix_selfies_total": ("counter", "Selfie lookups by event and outcome."),
+    "smartpix_event_faces": ("gauge", "Faces in the event's most recently loaded matcher."),
+    "smartpix_cache_hits_total": ("counter", "Cache hits (encodings: loaded matchers, images: proxied files)."),
+    "smartpix_cache_misses_total": ("counter", "Cache misses."),
+    "smartpix_cache_evictions_total": ("counter", "Cache evictions."),
+    "smartpix_cache_bytes": ("gauge", "Bytes held by the cache."),
+    "smartpix_encoding_jobs": ("gauge", "Encoding jobs known to this process, by status."),
+}
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def _prom_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, rendered in Prometheus text format."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> value (counters and gauges)
+        self._histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            hist[slot] += 1
+            hist[-1] += value
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        series = {}
+        for (name, labels), value in values:
+            series.setdefault(name, []).append(f"{name}{_prom_labels(labels)} {_prom_number(value)}")
+        bounds = self.buckets + (float("inf"),)
+        for (name, labels), hist in histograms:
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for le, count in zip(bounds, hist[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_prom_labels(labels + (('le', _prom_number(le)),))} {cumulative}")
+            lines.append(f"{name}_sum{_prom_labels(labels)} {_prom_number(float(hist[-1]))}")
+            lines.append(f"{name}_count{_prom_labels(labels)} {cumulative}")
+        out = []
+        for name in sorted(series):
+            kind, help_text = METRICS_HELP.get(name, ("untyped", name))
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + series[name]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def event_label(event):
+    """Metric label for an event; guest URLs are free-form, so unknown names become "other"."""
+    if not event:
+        return ""
+    known = {c["event"] for c in PHOTOGRAPHER_CREDENTIALS.values()} | set(EVENT_SETTINGS)
+    return event if event in known else "other"
+
+_stage_local = threading.local()
+
+@contextmanager
+def stage_context(scope, event=None, trace=None):
+    """
+    Defaults for stage() on this thread, for pool workers running on
+    behalf of a request: undotted stage names get the scope prefix, and
+    event / trace apply when stage() is not given them.
+    """
+    prev = getattr(_stage_local, "ctx", None)
+    _stage_local.ctx = (scope, event, trace)
+    try:
+        yield
+    finally:
+        _stage_local.ctx = prev
+
+def request_trace():
+    """This request's [(stage, ms)] list, or None outside a request."""
+    return g.get("trace") if has_request_context() else None
+
+@contextmanager
+def stage(name, event=None):
+    """
+    Time a block into smartpix_stage_seconds{stage, event} and the request
+    trace. An exception escaping the block counts in smartpix_errors_total.
+    """
+    scope, ctx_event, trace = getattr(_stage_local, "ctx", None) or (None, None, None)
+    if scope and "." not in name:
+        name = f"{scope}.{name}"
+    label = event_label(event or ctx_event)
+    if trace is None:
+        trace = request_trace()
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("smartpix_errors_total", stage=name, event=label)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        metrics.observe("smartpix_stage_seconds", elapsed, stage=name, event=label)
+        if trace is not None:
+            trace.append((name, round(elapsed * 1000, 1)))
+
+def record_error(stage_name, error, event=None, level=logging.ERROR, **fields):
+    """Count and log an error that was handled (not raised) in stage_name."""
+    metrics.inc("smartpix_errors_total", stage=stage_name, event=event_label(event))
+    log_kv("failed", level, stage=stage_name, event=event, error=error, **fields)
+
+@contextmanager
+def cloudinary_call(op):
+    """Count and time one Cloudinary API / CDN call; exceptions count as errors."""
+    metrics.inc("smartpix_cloudinary_calls_total", op=op)
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("smartpix_cloudinary_errors_total", op=op)
+        raise
+    finally:
+        metrics.observe("smartpix_cloudinary_seconds", time.perf_counter() - t0, op=op)
+
+@app.before_request
+def _start_request_trace():
+    g.trace = []
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unknown"
+    metrics.inc("smartpix_requests_total", endpoint=endpoint, status=response.status_code)
+    metrics.observe("smartpix_request_seconds", elapsed, endpoint=endpoint)
+    if SLOW_TRACE_MS and elapsed * 1000 >= SLOW_TRACE_MS and random.random() < TRACE_SAMPLE_RATE:
+        log_kv("slow request", logging.WARNING, method=request.method, path=request.path,
+               status=response.status_code, ms=round(elapsed * 1000, 1),
+               stages=",".join(f"{name}:{ms}" for name, ms in g.trace))
+    return response
+
 # -------------------- HELPERS --------------------
 def generate_qr(event):
     link = f"{BASE_URL}/guest/{event}"
     qr_path = os.path.join(QR_DIR, f"{event}_QR.png")
     img = qrcode.make(link)
     img.save(qr_path)
-    print("✅ QR Generated:", qr_path, "->", link)
+    log_kv("qr generated", event=event, path=qr_path, link=link)
     return qr_path, link
 
+# -------------------- ENCODINGS STORE --------------------
+# Per event:  <event>.npy         float32 (N, 128) matrix, fixed-size header so
+#                                 rows can be appended in place; opened with mmap
+#             <event>.meta.jsonl  one [public_id, face_index, url] line per row
+#             <event>.json        legacy format, migrated on first use
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+ROW_BYTES = 128 * 4
+
 def local_encoding_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.npy")
+
+def local_meta_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.meta.jsonl")
+
+def legacy_encoding_path(event):
     return os.path.join(ENCODINGS_DIR, f"{event}.json")
 
+_encodings_write_locks = {}
+_encodings_lock_depth = threading.local()
+
+@contextmanager
+def encodings_lock(event, shared=False):
+    """Cross-worker lock on an event's store (flock where available), re-entrant per thread."""
+    held = _encodings_lock_depth.__dict__.setdefault("held", {})
+    if held.get(event):
+        held[event] += 1
+        try:
+            yield
+        finally:
+            held[event] -= 1
+        return
+    thread_lock = _encodings_write_locks.setdefault(event, threading.RLock())
+    if not shared:
+        thread_lock.acquire()
+    held[event] = 1
+    try:
+        with open(os.path.join(ENCODINGS_DIR, f"{event}.lock"), "a") as fh:
+            if fcntl:
+                fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+    finally:
+        held[event] = 0
+        if not shared:
+            thread_lock.release()
+
+def _npy_header(rows):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, 128), }" % rows
+    body_len = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    return NPY_MAGIC + struct.pack("<H", body_len) + header.ljust(body_len - 1).encode("latin1") + b"\n"
+
+def _npy_rows(f):
+    f.seek(0)
+    head = f.read(NPY_HEADER_SIZE)
+    if len(head) < NPY_HEADER_SIZE or not head.startswith(NPY_MAGIC):
+        return 0
+    return int(head.split(b"'shape': (")[1].split(b",")[0])
+
+def _read_meta(event, rows=None):
+    meta = []
+    try:
+        with open(local_meta_path(event), "r") as f:
+            for line in f:
+                if rows is not None and len(meta) >= rows:
+                    break
+                try:
+                    meta.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line from an interrupted append
+    except FileNotFoundError:
+        pass
+    return meta
+
+def _count_meta_lines(event):
+    try:
+        with open(local_meta_path(event), "rb") as f:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+    except FileNotFoundError:
+        return 0
+
+def _meta_line(item):
+    return json.dumps([item.get("public_id"), item.get("face_index", 0), item.get("url")]) + "\n"
+
+def _vectors(items):
+    return np.asarray([item["encoding"] for item in items], dtype="<f4").reshape(-1, 128)
+
+def open_encodings_store(event):
+    """
+    Return (matrix, meta) for an event: matrix is a read-only mmap of the
+    float32 rows (shared page cache across workers), meta the parallel
+    [public_id, face_index, url] rows. None if the event has no encodings.
+    """
+    if not os.path.exists(local_encoding_path(event)) and not migrate_json_encodings(event):
+        return None
+    with encodings_lock(event, shared=True):
+        p = local_encoding_path(event)
+        with open(p, "rb") as f:
+            rows = _npy_rows(f)
+        meta = _read_meta(event, rows)
+        rows = min(rows, len(meta))
+        if rows == 0:
+            return np.empty((0, 128), dtype=np.float32), []
+        matrix = np.memmap(p, dtype="<f4", mode="r", offset=NPY_HEADER_SIZE, shape=(rows, 128))
+    return matrix, meta[:rows]
+
 def load_local_encodings(event):
-    p = local_encoding_path(event)
-    if not os.path.exists(p):
-        return []
+    """Event encodings as the legacy list of {public_id, face_index, url, encoding} dicts."""
     try:
-        with open(p, "r") as f:
-            return json.load(f)
+        store = open_encodings_store(event)
     except Exception as e:
-        print("⚠️ Failed to load local encodings:", e)
+        record_error("encodings.load", e, event, logging.WARNING)
         return []
+    if store is None:
+        return []
+    matrix, meta = store
+    return [
+        {"public_id": pubid, "face_index": idx, "url": url, "encoding": enc.tolist()}
+        for (pubid, idx, url), enc in zip(meta, matrix)
+    ]
 
 def save_local_encodings(event, enc_list):
+    """Replace an event's store with enc_list (legacy dict format)."""
     p = local_encoding_path(event)
     try:
-        with open(p, "w") as f:
-            json.dump(enc_list, f)
-        print("💾 Saved local encodings:", p)
+        with encodings_lock(event):
+            vecs = _vectors(enc_list)
+            with open(p + ".tmp", "wb") as f:
+                f.write(_npy_header(len(vecs)))
+                f.write(vecs.tobytes())
+            with open(local_meta_path(event) + ".tmp", "w") as f:
+                f.writelines(_meta_line(item) for item in enc_list)
+            os.replace(local_meta_path(event) + ".tmp", local_meta_path(event))
+            os.replace(p + ".tmp", p)
+            # rows were renumbered: indexes over the old rows are rebuilt on demand
+            for side in (clusters_path(event), ann_index_path(event)):
+                if os.path.exists(side):
+                    os.remove(side)
+        bump_encodings_version(event)
+        log_kv("encodings saved", event=event, path=p, faces=len(enc_list))
         return True
     except Exception as e:
-        print("❌ Could not save local encodings:", e)
+        record_error("encodings.save", e, event)
         return False
 
-def upload_encodings_to_cloud(event):
-    """Upload encodings JSON to Cloudinary as a raw resource (persistent)."""
+def _stored_keys(event, public_ids, rows):
+    """
+    (public_id, face_index) of the first rows stored faces whose photo is
+    in public_ids. Meta lines are matched on their raw prefix, so new
+    photos (the common case) cost a byte search and only the matching
+    lines are parsed.
+    """
+    prefixes = tuple(b"[" + json.dumps(pubid).encode("utf-8") + b"," for pubid in public_ids)
+    try:
+        with open(local_meta_path(event), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return set()
+    if not any(prefix in data for prefix in prefixes):
+        return set()
+    keys = set()
+    for line in data.split(b"\n")[:rows]:
+        if line.startswith(prefixes):
+            pubid, idx, _ = json.loads(line)
+            keys.add((pubid, idx))
+    return keys
+
+def append_local_encodings(event, items):
+    """
+    Append new face entries to an event's store without rewriting it.
+    Faces already stored under the same (public_id, face_index) are
+    skipped: a reconcile pass can list and encode an uploaded photo
+    before the upload has stored its faces. Returns the number of rows
+    appended, None on failure.
+    """
+    if not items:
+        return 0
     p = local_encoding_path(event)
-    if not os.path.exists(p):
-        print("⚠️ No local encodings to upload for", event)
+    try:
+        with encodings_lock(event):
+            if not os.path.exists(p):
+                migrate_json_encodings(event)
+            with open(p, "r+b" if os.path.exists(p) else "w+b") as f:
+                rows = _npy_rows(f)
+                if _count_meta_lines(event) != rows:
+                    # interrupted append: cut both files back to the header count
+                    meta = _read_meta(event, rows)
+                    rows = len(meta)
+                    with open(local_meta_path(event), "w") as m:
+                        m.writelines(json.dumps(row) + "\n" for row in meta)
+                have = _stored_keys(event, {item.get("public_id") for item in items if item.get("public_id")}, rows)
+                new = []
+                for item in items:
+                    key = (item.get("public_id"), item.get("face_index", 0))
+                    if key[0] and key in have:
+                        continue
+                    have.add(key)
+                    new.append(item)
+                if not new:
+                    return 0
+                vecs = _vectors(new)
+                f.truncate(NPY_HEADER_SIZE + rows * ROW_BYTES)
+                f.seek(NPY_HEADER_SIZE + rows * ROW_BYTES)
+                f.write(vecs.tobytes())
+                f.flush()
+                with open(local_meta_path(event), "a") as m:
+                    m.writelines(_meta_line(item) for item in new)
+                # header last: readers never see rows that aren't fully written
+                f.seek(0)
+                f.write(_npy_header(rows + len(vecs)))
+        bump_encodings_version(event)
+        log_kv("encodings appended", event=event, path=p, faces=len(new), duplicates=len(items) - len(new))
+        return len(new)
+    except Exception as e:
+        record_error("encodings.append", e, event)
         return None
-    pubid = f"encodings/{event}/encodings"
+
+def migrate_json_encodings(event):
+    """One-time conversion of encodings/<event>.json to the binary store."""
+    legacy = legacy_encoding_path(event)
+    if not os.path.exists(legacy):
+        return False
     try:
-        res = cloudinary.uploader.upload(
-            p,
-            public_id=pubid,
-            resource_type="raw",
-            overwrite=True
-        )
-        print("☁️ Uploaded encodings JSON to Cloudinary:", pubid)
-        return res
+        with open(legacy, "r") as f:
+            enc_list = json.load(f)
+    except Exception as e:
+        record_error("encodings.migrate", e, event, logging.WARNING)
+        return False
+    with encodings_lock(event):
+        if os.path.exists(local_encoding_path(event)):
+            return True
+        log_kv("migrating legacy encodings", event=event, path=legacy, faces=len(enc_list))
+        return save_local_encodings(event, enc_list)
+
+def migrate_all_json_encodings():
+    for name in sorted(os.listdir(ENCODINGS_DIR)):
+        if name.endswith(".json"):
+            migrate_json_encodings(name[:-len(".json")])
+
+def store_items(event, start=0, end=None):
+    """Rows [start, end) of an event's store as {public_id, face_index, url, encoding} dicts."""
+    store = open_encodings_store(event)
+    if store is None:
+        return []
+    matrix, meta = store
+    end = len(meta) if end is None else min(end, len(meta))
+    return [
+        {"public_id": meta[i][0], "face_index": meta[i][1], "url": meta[i][2], "encoding": matrix[i]}
+        for i in range(start, end)
+    ]
+
+def _save_npz(path, **arrays):
+    """Atomically replace an index file next to the store (temp name unique per writer)."""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp.npz"
+    try:
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _index_inputs(event, index_path):
+    """
+    What an index file derived from the store was computed from: the
+    store's inode (replaced on rewrite, kept by appends; an open memmap
+    keeps it from being reused) and the index file's inode and mtime
+    (replaced on every save). Writers compare it before swapping a file in.
+    """
+    try:
+        store = os.stat(local_encoding_path(event)).st_ino
+    except OSError:
+        store = None
+    try:
+        st = os.stat(index_path)
+        index = (st.st_ino, st.st_mtime_ns)
+    except OSError:
+        index = None
+    return store, index
+
+def _load_npz(path):
+    """{name: array} from an index file; None if it is missing or unreadable (callers rebuild)."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        print("❌ Upload encodings to Cloudinary failed:", e)
+        record_error("store.index_file", e, level=logging.WARNING, path=path)
         return None
 
-def get_cloudinary_encodings_url(event):
-    pubid = f"encodings/{event}/encodings"
+# -------------------- ENCODINGS SYNC --------------------
+# Remote layout per event (Cloudinary raw resources, or a local stand-in):
+#   encodings/<event>/manifest.json      {version, base, shards: [{key, version, faces}]}
+#   encodings/<event>/shards/<v>.npz     faces added by one ingest batch (or a
+#                                        compacted base holding everything)
+#   encodings/<event>/encodings          legacy full JSON, read if no manifest
+# Nodes poll the manifest with If-None-Match and fetch only missing shards.
+# One node publishes per event (the one taking that photographer's uploads).
+class CloudinaryRemote:
+    """Raw Cloudinary resources, read through the CDN (no admin API calls)."""
+
+    def put(self, key, data):
+        with cloudinary_call("raw_upload"):
+            cloudinary.uploader.upload(
+                BytesIO(data),
+                public_id=key,
+                resource_type="raw",
+                overwrite=True,
+                invalidate=True
+            )
+
+    def get(self, key, etag=None, fresh=False):
+        """
+        (status, data, etag): 200 with data, 304 if unchanged, 404 if
+        missing; any other status raises DownloadError. fresh=True puts a
+        new version component in the URL, which the CDN has never cached.
+        """
+        options = {"version": time.time_ns() // 1_000_000} if fresh else {}
+        url = cloudinary.utils.cloudinary_url(key, resource_type="raw", secure=True, **options)[0]
+        headers = {"If-None-Match": etag} if etag else {}
+        with cloudinary_call("raw_get"):
+            r = HTTP.get(url, headers=headers, timeout=20)
+        if r.status_code == 304:
+            return 304, None, etag
+        if r.status_code == 404:
+            return 404, None, None
+        if r.status_code != 200:
+            raise DownloadError(f"{key}: HTTP {r.status_code}")
+        return 200, r.content, r.headers.get("ETag")
+
+class LocalRemote:
+    """Directory stand-in for Cloudinary, for tests, benchmarks and single-box setups."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        p = self._path(key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(p + ".tmp", p)
+
+    def get(self, key, etag=None, fresh=False):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 404, None, None
+        tag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if etag == tag:
+            return 304, None, etag
+        return 200, data, tag
+
+def make_remote(spec):
+    if spec.startswith("local:"):
+        return LocalRemote(spec[len("local:"):])
+    return CloudinaryRemote()
+
+encodings_remote = make_remote(ENCODINGS_REMOTE)
+
+def manifest_key(event):
+    return f"encodings/{event}/manifest.json"
+
+def shard_key(event, version):
+    return f"encodings/{event}/shards/{version:08d}.npz"
+
+def sync_state_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.sync.json")
+
+def load_sync_state(event):
+    """
+    What this box has of the remote: manifest version/etag, base and
+    applied shard keys, and synced_rows - local rows [0, synced_rows)
+    are in the remote; rows after that are local faces not yet published.
+    """
     try:
-        res = cloudinary.api.resource(pubid, resource_type="raw")
-        url = res.get("secure_url") or res.get("url")
-        return url
-    except Exception:
+        with open(sync_state_path(event), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": 0, "etag": None, "base": None, "applied": [], "synced_rows": 0}
+
+def save_sync_state(event, state):
+    p = sync_state_path(event)
+    with open(p + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(p + ".tmp", p)
+
+def encode_shard(items):
+    buf = BytesIO()
+    meta = json.dumps([[item["public_id"], item.get("face_index", 0), item["url"]] for item in items])
+    np.savez(buf, vectors=_vectors(items), meta=np.array(meta))
+    return buf.getvalue()
+
+def decode_shard(data):
+    with np.load(BytesIO(data), allow_pickle=False) as z:
+        vectors = z["vectors"]
+        meta = json.loads(str(z["meta"]))
+    return [
+        {"public_id": pubid, "face_index": idx, "url": url, "encoding": enc}
+        for (pubid, idx, url), enc in zip(meta, vectors)
+    ]
+
+def _local_rows(event):
+    store = open_encodings_store(event)
+    return len(store[1]) if store is not None else 0
+
+def _apply_remote_items(event, items):
+    """Append remote faces this box does not have yet (deduplicated by public_id + face_index)."""
+    have = {(pubid, idx) for pubid, idx, _ in _read_meta(event)}
+    new = [item for item in items if (item["public_id"], item.get("face_index", 0)) not in have]
+    if new:
+        add_event_faces(event, new, publish=False)
+    return len(new)
+
+def _fetch_manifest(event, etag=None, fresh=False):
+    status, data, etag = encodings_remote.get(manifest_key(event), etag, fresh=fresh)
+    if status != 200:
+        return status, None, etag
+    return status, json.loads(data.decode("utf-8")), etag
+
+def _fetch_missing_shards(manifest, state):
+    """Download and decode the base/shards of manifest that state has not applied (no lock held)."""
+    keys = []
+    if manifest.get("base") and manifest["base"] != state.get("base"):
+        keys.append(manifest["base"])
+    applied = set(state["applied"])
+    keys += [shard["key"] for shard in manifest["shards"] if shard["key"] not in applied]
+    batches = []
+    for key in keys:
+        status, data, _ = encodings_remote.get(key)
+        if status != 200:
+            raise DownloadError(f"missing shard {key}")
+        batches.append(decode_shard(data))
+    return batches
+
+def _apply_manifest(event, manifest, state, batches):
+    """Store fetched shard batches and record manifest as applied (caller holds the lock). Returns faces added."""
+    added = sum(_apply_remote_items(event, items) for items in batches)
+    state.update(
+        version=manifest["version"],
+        base=manifest.get("base"),
+        applied=[shard["key"] for shard in manifest["shards"]],
+    )
+    return added
+
+def pull_encodings(event):
+    """
+    Bring this box's store up to the remote manifest: a conditional GET of
+    the manifest (304 = nothing to do), then only the missing shards.
+    Falls back to the legacy full JSON when the event has no manifest.
+    Network calls run unlocked; the store lock is only held to apply the
+    rows and write the sync state. Returns the number of faces added, or
+    None if nothing changed.
+    """
+    state = load_sync_state(event)
+    rows = _local_rows(event)
+    if rows > state["synced_rows"] and state["version"]:
+        # unpublished local faces: publish_encodings pulls and pushes together
+        return None
+    status, manifest, etag = _fetch_manifest(event, state.get("etag"))
+    if status == 304:
         return None
+    if manifest is None:
+        if rows:
+            return None
+        enc_list = download_legacy_encodings(event)
+        return len(enc_list) if enc_list else None
+    batches = _fetch_missing_shards(manifest, state)
+    with encodings_lock(event):
+        state = load_sync_state(event)
+        if state["version"] >= manifest["version"]:
+            # another thread or worker applied it meanwhile
+            return None
+        if _local_rows(event) > state["synced_rows"] and state["version"]:
+            return None
+        # batches were fetched against an older or equal state; applying
+        # one twice is harmless since rows are deduplicated by key
+        added = _apply_manifest(event, manifest, state, batches)
+        state["etag"] = etag
+        state["synced_rows"] = _local_rows(event)
+        save_sync_state(event, state)
+    if added:
+        log_kv("encodings pulled", event=event, faces=added, version=manifest["version"])
+    return added
+
+def _check_manifest_current(manifest, state):
+    """
+    Raise if manifest is older than the version state has applied (a
+    stale read): publishing on top of it would reuse a version number and
+    drop the shards published since.
+    """
+    remote_version = manifest["version"] if manifest is not None else 0
+    if remote_version < state["version"]:
+        raise DownloadError(f"stale manifest: remote v{remote_version}, this box has v{state['version']}")
+
+def publish_encodings(event):
+    """
+    Publish this box's unpublished faces as one delta shard and bump the
+    manifest version, compacting into a single base shard every
+    SYNC_COMPACT_SHARDS shards. Remote shards this box is missing are
+    applied first. Publishers of an event take turns on a lock of their
+    own; the store lock is only held while rows are applied and read and
+    the sync state is written, never across uploads. The manifest is read
+    past the CDN cache, and one older than this box's sync state (a stale
+    read) is refused rather than published over. Returns the new version,
+    or None on failure.
+    """
+    try:
+        with encodings_lock(f"{event}.publish"):
+            state = load_sync_state(event)
+            status, manifest, _ = _fetch_manifest(event, fresh=True)
+            _check_manifest_current(manifest, state)
+            batches = []
+            if manifest is not None and manifest["version"] != state["version"]:
+                batches = _fetch_missing_shards(manifest, state)
+
+            with encodings_lock(event):
+                state = load_sync_state(event)
+                # a pull may have applied a newer manifest meanwhile
+                _check_manifest_current(manifest, state)
+                before_pull = _local_rows(event)
+                if manifest is not None and manifest["version"] != state["version"]:
+                    _apply_manifest(event, manifest, state, batches)
+                synced_rows = _local_rows(event)
+                delta = store_items(event, state["synced_rows"], before_pull)
+                if not delta and manifest is not None:
+                    state["synced_rows"] = synced_rows
+                    save_sync_state(event, state)
+                    return manifest["version"]
+                version = manifest["version"] + 1 if manifest else 1
+                shards = manifest["shards"] if manifest else []
+                compact = manifest is None or len(shards) + 1 >= SYNC_COMPACT_SHARDS
+                # compaction: after the pull above this box holds the full remote state
+                payload = encode_shard(store_items(event, 0, synced_rows) if compact else delta)
+
+            key = shard_key(event, version)
+            encodings_remote.put(key, payload)
+            if compact:
+                base, shards = key, []
+            else:
+                base = manifest.get("base")
+                shards = shards + [{"key": key, "version": version, "faces": len(delta)}]
+            new_manifest = {"event": event, "version": version, "base": base,
+                            "shards": shards, "updated": int(time.time())}
+            encodings_remote.put(manifest_key(event), json.dumps(new_manifest).encode("utf-8"))
 
-def download_encodings_from_cloud(event):
-    url = get_cloudinary_encodings_url(event)
-    if not url:
-        print("⚠️ No encodings file in Cloudinary for", event)
+            with encodings_lock(event):
+                state = load_sync_state(event)
+                # rows appended during the upload stay unsynced for the next push
+                state.update(version=version, base=base, applied=[s["key"] for s in shards],
+                             etag=None, synced_rows=synced_rows)
+                save_sync_state(event, state)
+        log_kv("encodings published", event=event, faces=len(delta), version=version)
+        return version
+    except Exception as e:
+        record_error("sync.publish", e, event)
         return None
+
+def download_legacy_encodings(event):
+    """Read the pre-manifest full encodings JSON (via the CDN) into the local store."""
     try:
-        r = requests.get(url, timeout=20)
-        if r.status_code != 200:
-            print("⚠️ Cloudinary encodings download returned", r.status_code)
+        status, data, _ = encodings_remote.get(f"encodings/{event}/encodings")
+        if status != 200:
+            log_kv("no remote encodings", logging.WARNING, event=event)
             return None
-        enc_list = json.loads(r.content.decode("utf-8"))
+        enc_list = json.loads(data.decode("utf-8"))
         save_local_encodings(event, enc_list)
-        print("☁️ Downloaded encodings JSON from Cloudinary for", event)
+        log_kv("legacy encodings downloaded", event=event, faces=len(enc_list))
         return enc_list
     except Exception as e:
-        print("❌ Failed downloading encodings from Cloudinary:", e)
+        record_error("sync.legacy_download", e, event)
         return None
 
-# -------------------- ENCODING GENERATION (GROUP SUPPORT) --------------------
-def generate_encodings_for_event(event):
+# -------------------- FACE DETECTION --------------------
+def detect_and_encode(img, profile="balanced"):
+    """
+    Face encodings for an RGB image array. Detection runs on a copy
+    downscaled per the profile (HOG cost grows with pixel count); boxes
+    are mapped back so encodings are computed on the full image.
+    """
+    if isinstance(profile, str):
+        profile = DETECTION_PROFILES[profile]
+    h, w = img.shape[:2]
+    max_dim = profile["detect_max_dim"]
+    scale = 1.0
+    small = img
+    if max_dim and max(h, w) > max_dim:
+        scale = max_dim / max(h, w)
+        small = np.asarray(Image.fromarray(img).resize(
+            (max(round(w * scale), 1), max(round(h * scale), 1)), Image.BILINEAR, reducing_gap=2.0
+        ))
+    with stage("detect"):
+        boxes = face_recognition.face_locations(
+            small, number_of_times_to_upsample=profile["upsample"], model=profile["model"]
+        )
+    if not boxes:
+        return []
+    if scale != 1.0:
+        inv = 1.0 / scale
+        boxes = [
+            (max(int(top * inv), 0), min(int(right * inv), w), min(int(bottom * inv), h), max(int(left * inv), 0))
+            for top, right, bottom, left in boxes
+        ]
+    with stage("encode"):
+        return face_recognition.face_encodings(img, known_face_locations=boxes, num_jitters=profile["num_jitters"])
+
+def load_image(stream, max_dim):
+    """
+    Decode an upload to an upright RGB PIL image no larger than max_dim.
+    JPEGs are decoded in draft mode (DCT scaling) close to the target
+    size, so a 24MP original is never fully decoded.
+    """
+    img = Image.open(stream)
+    if img.format == "JPEG":
+        img.draft("RGB", (max_dim, max_dim))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_dim, max_dim))
+    return img
+
+def decode_image(stream, max_dim):
+    """load_image as an RGB array."""
+    return np.asarray(load_image(stream, max_dim))
+
+# -------------------- MATCHING --------------------
+class EventMatcher:
+    """
+    All face encodings of one event as one contiguous float32 matrix,
+    with parallel public_id / face_index / url lists (one row per face).
+    """
+
+    def __init__(self, matrix, public_ids, face_indexes, urls, ann=None, clusters=None):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, 128)
+        self.ann = ann
+        self.clusters = clusters
+        self.public_ids = public_ids
+        self.face_indexes = face_indexes
+        self.urls = urls
+        # one integer id per distinct url, so dedup is a vector op
+        url_ids = {}
+        self.url_ids = np.array([url_ids.setdefault(u, len(url_ids)) for u in urls], dtype=np.int64)
+        # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, row norms computed once
+        self.sq_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+
+    @classmethod
+    def from_entries(cls, enc_list):
+        rows, public_ids, face_indexes, urls = [], [], [], []
+        for item in enc_list:
+            enc = item.get("encoding")
+            if not enc or len(enc) != 128:
+                continue
+            rows.append(enc)
+            public_ids.append(item.get("public_id"))
+            face_indexes.append(item.get("face_index", 0))
+            urls.append(item.get("url"))
+        matrix = np.array(rows, dtype=np.float32).reshape(-1, 128)
+        return cls(matrix, public_ids, face_indexes, urls)
+
+    @classmethod
+    def from_store(cls, event):
+        store = open_encodings_store(event)
+        if store is None:
+            return cls(np.empty((0, 128), dtype=np.float32), [], [], [])
+        matrix, meta = store
+        public_ids = [row[0] for row in meta]
+        face_indexes = [row[1] for row in meta]
+        urls = [row[2] for row in meta]
+        settings = event_settings(event)
+        ann = clusters = None
+        # clusters take precedence over the IVF index, which is only kept without them
+        if not settings["clusters"] and len(matrix) >= settings["ann_min_faces"]:
+            ann = IVFIndex.load(ann_index_path(event))
+            if ann is not None and len(ann) > len(matrix):
+                ann = None  # built over rows that no longer exist
+            if ann is not None:
+                ann.sync(matrix)
+            else:
+                # large event stored without an index (or its file was unusable)
+                schedule_ann_build(event)
+        if settings["clusters"]:
+            clusters = PersonClusters.load(clusters_path(event), settings["cluster_radius"])
+            if clusters is not None and len(clusters) > len(matrix):
+                clusters = None
+            if clusters is not None:
+                clusters.sync(matrix)
+            elif len(matrix):
+                # event stored before clustering existed (or its file was unusable)
+                schedule_cluster_build(event)
+        return cls(matrix, public_ids, face_indexes, urls, ann=ann, clusters=clusters)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def distances(self, face_encoding):
+        """Euclidean distance from one encoding to every stored face."""
+        q = np.asarray(face_encoding, dtype=np.float32)
+        d2 = self.sq_norms - 2.0 * (self.matrix @ q) + float(q @ q)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def row_distances(self, face_encoding, rows):
+        """Euclidean distance from one encoding to the given rows only."""
+        q = np.asarray(face_encoding, dtype=np.float32)
+        d2 = self.sq_norms[rows] - 2.0 * (self.matrix[rows] @ q) + float(q @ q)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def match(self, face_encoding, tolerance=0.55, top_k=0, nprobe=None, margin=None, refine=True):
+        """
+        Return [(url, distance)] within tolerance, one per url, best first.
+        With person clusters and a margin, the selfie is compared with
+        cluster centroids (see match_clusters). Otherwise, with an ANN
+        index and nprobe, only rows in the nprobe nearest coarse cells
+        are compared.
+        """
+        if not len(self):
+            return []
+        if self.clusters is not None and margin is not None:
+            return self.match_clusters(face_encoding, tolerance, top_k, margin, refine)
+        if self.ann is not None and nprobe:
+            rows = self.ann.candidates(face_encoding, nprobe)
+            dist = self.row_distances(face_encoding, rows)
+            keep = dist <= tolerance
+            return self.rank(rows[keep], dist[keep], top_k)
+        dist = self.distances(face_encoding)
+        rows = np.flatnonzero(dist <= tolerance)
+        return self.rank(rows, dist[rows], top_k)
+
+    def match_clusters(self, face_encoding, tolerance, top_k, margin, refine=True):
+        """
+        Clusters whose centroid is within tolerance - margin match as a
+        whole (their photos ranked by centroid distance). Clusters in the
+        band up to tolerance + margin are refined against their members
+        when refine is set, else taken whole if within tolerance.
+        """
+        dc = self.clusters.centroid_distances(face_encoding)
+        direct = np.flatnonzero(dc <= tolerance - margin)
+        border = np.flatnonzero((dc > tolerance - margin) & (dc <= tolerance + margin))
+        if not refine:
+            direct, border = np.flatnonzero(dc <= tolerance), border[:0]
+        rows = self.clusters.members(direct)
+        dist = dc[self.clusters.labels[rows]]
+        if len(border):
+            border_rows = self.clusters.members(border)
+            border_dist = self.row_distances(face_encoding, border_rows)
+            keep = border_dist <= tolerance
+            rows = np.concatenate([rows, border_rows[keep]])
+            dist = np.concatenate([dist, border_dist[keep]])
+        return self.rank(rows, dist, top_k)
+
+    def rank(self, rows, dist, top_k=0):
+        """Order candidate rows by distance and keep the best row per url."""
+        order = np.argsort(dist, kind="stable")
+        rows, dist = rows[order], dist[order]
+        _, first = np.unique(self.url_ids[rows], return_index=True)
+        first.sort()
+        if top_k:
+            first = first[:top_k]
+        return [(self.urls[r], float(d)) for r, d in zip(rows[first], dist[first])]
+
+# -------------------- ANN INDEX (IVF) --------------------
+def ann_index_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.ivf.npz")
+
+def _nearest_centroid(vectors, centroids, chunk=16384):
+    """Index of the nearest centroid for each row, in chunks to bound memory."""
+    c_norms = np.einsum("ij,ij->i", centroids, centroids)
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+        # |x|^2 is the same for every centroid, so it can be left out
+        out[start:start + chunk] = np.argmin(c_norms - 2.0 * (block @ centroids.T), axis=1)
+    return out
+
+class IVFIndex:
+    """
+    Inverted-file index over an event's encodings: a k-means coarse
+    quantizer, and each row filed under its nearest centroid. A search
+    compares the query only with rows in the nprobe nearest cells.
+    """
+
+    def __init__(self, centroids, assign, built_rows):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assign = np.asarray(assign, dtype=np.int32)
+        self.built_rows = int(built_rows)
+        self._reindex()
+
+    @classmethod
+    def build(cls, matrix, nlist=None, iters=10, sample=100000, seed=0):
+        n = len(matrix)
+        nlist = nlist or max(1, min(int(4 * np.sqrt(n)), n))
+        rng = np.random.default_rng(seed)
+        train_rows = np.sort(rng.choice(n, size=min(n, max(sample, nlist)), replace=False))
+        train = np.asarray(matrix[train_rows], dtype=np.float32)
+        centroids = train[rng.choice(len(train), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            labels = _nearest_centroid(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, train)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # reseed empty cells from random training rows
+            if empty.any():
+                centroids[empty] = train[rng.choice(len(train), size=int(empty.sum()))]
+        return cls(centroids, _nearest_centroid(matrix, centroids), n)
+
+    def _reindex(self):
+        self._order = np.argsort(self.assign, kind="stable").astype(np.int64)
+        self._bounds = np.searchsorted(self.assign[self._order], np.arange(len(self.centroids) + 1))
+
+    def __len__(self):
+        return len(self.assign)
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.assign.nbytes + self._order.nbytes
+
+    def add(self, vectors):
+        """File new rows (appended after the indexed ones) under their nearest cell."""
+        if len(vectors):
+            self.assign = np.concatenate([self.assign, _nearest_centroid(vectors, self.centroids)])
+            self._reindex()
+
+    def sync(self, matrix):
+        """Index any rows of matrix added since the index was saved."""
+        if len(matrix) > len(self):
+            self.add(matrix[len(self):])
+
+    def candidates(self, face_encoding, nprobe):
+        q = np.asarray(face_encoding, dtype=np.float32)
+        d = np.einsum("ij,ij->i", self.centroids, self.centroids) - 2.0 * (self.centroids @ q)
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(d, nprobe - 1)[:nprobe]
+        return np.concatenate([self._order[self._bounds[c]:self._bounds[c + 1]] for c in probes])
+
+    def save(self, path):
+        _save_npz(path, centroids=self.centroids, assign=self.assign, built_rows=self.built_rows)
+
+    @classmethod
+    def load(cls, path):
+        data = _load_npz(path)
+        try:
+            return cls(data["centroids"], data["assign"], int(data["built_rows"]))
+        except (TypeError, KeyError, ValueError):
+            return None
+
+def update_ann_index(event, background=False):
+    """
+    Keep the event's IVF index in step with its store: new rows are filed
+    under existing cells, and the quantizer is retrained once the event
+    has doubled since the last build. Small events get no index, and
+    neither do events searched through person clusters (with both, the
+    clusters win in EventMatcher.match, so the index would go unused).
+    background=True (request threads) hands a first build or a retrain to
+    schedule_ann_build and returns None. As in update_clusters, the work
+    runs with no lock held and the exclusive lock only covers the swap.
+    """
+    settings = event_settings(event)
+    if settings["clusters"]:
+        return None
+    path = ann_index_path(event)
+    for _ in range(3):
+        seen = _index_inputs(event, path)
+        store = open_encodings_store(event)
+        if store is None:
+            return None
+        matrix = store[0]
+        if len(matrix) < settings["ann_min_faces"]:
+            return None
+        index = IVFIndex.load(path)
+        if index is None or len(index) > len(matrix) or len(matrix) >= 2 * index.built_rows:
+            if background:
+                schedule_ann_build(event)
+                return None
+            log_kv("building ann index", event=event, faces=len(matrix))
+            index = IVFIndex.build(matrix)
+        else:
+            index.sync(matrix)
+        with encodings_lock(event):
+            if _index_inputs(event, path) == seen:
+                index.save(path)
+                return index
+    return None
+
+def schedule_ann_build(event):
+    """Build or retrain the event's IVF index on a background thread (see schedule_cluster_build)."""
+    _schedule_index_build("store.ann_index", event, update_ann_index)
+
+def ann_recall_report(event, nprobes=(1, 2, 4, 8, 16, 32), n_queries=200, noise=0.02, seed=0):
+    """
+    Recall and latency of IVF search vs exact search for an event. Queries
+    are stored faces plus a little noise; recall is the share of exact
+    matches (urls) the ANN search also returns. An index is built in
+    memory if the event does not have one.
+    """
+    matcher = EventMatcher.from_store(event)
+    if not len(matcher):
+        return []
+    ann = matcher.ann or IVFIndex.build(matcher.matrix)
+    matcher.ann = ann
+    tolerance = event_settings(event)["tolerance"]
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matcher), size=min(n_queries, len(matcher)), replace=False)
+    queries = np.asarray(matcher.matrix[rows]) + rng.normal(0, noise, (len(rows), 128)).astype(np.float32)
+
+    t0 = time.perf_counter()
+    exact = [{url for url, _ in matcher.match(q, tolerance)} for q in queries]
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    report = [{"event": event, "faces": len(matcher), "cells": len(ann.centroids),
+               "nprobe": None, "recall": 1.0, "ms_per_query": round(exact_ms, 3)}]
+    for nprobe in nprobes:
+        t0 = time.perf_counter()
+        approx = [{url for url, _ in matcher.match(q, tolerance, nprobe=nprobe)} for q in queries]
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        hits = sum(len(a & e) for a, e in zip(approx, exact))
+        total = sum(len(e) for e in exact)
+        report.append({"event": event, "faces": len(matcher), "cells": len(ann.centroids),
+                       "nprobe": nprobe, "recall": round(hits / total, 4) if total else 1.0,
+                       "ms_per_query": round(ms, 3)})
+    return report
+
+# -------------------- PERSON CLUSTERS --------------------
+def clusters_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.clusters.npz")
+
+class PersonClusters:
+    """
+    Faces of an event grouped into people: each face joins the nearest
+    cluster whose centroid (running mean) is within radius, or starts a
+    new one. labels maps row -> cluster; members() is the inverted index
+    from clusters back to rows (and so to photo urls).
+    """
+
+    def __init__(self, centroids, counts, labels, radius):
+        self.centroids = np.asarray(centroids, dtype=np.float32).reshape(-1, 128)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.radius = radius
+        self._reindex()
+
+    @classmethod
+    def empty(cls, radius):
+        return cls(np.empty((0, 128), np.float32), np.empty(0, np.int64), np.empty(0, np.int32), radius)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.counts.nbytes + self.labels.nbytes + self._order.nbytes
+
+    def _reindex(self):
+        self._order = np.argsort(self.labels, kind="stable").astype(np.int64)
+        self._bounds = np.searchsorted(self.labels[self._order], np.arange(len(self.centroids) + 1))
+
+    def centroid_distances(self, face_encoding):
+        q = np.asarray(face_encoding, dtype=np.float32)
+        d2 = np.einsum("ij,ij->i", self.centroids, self.centroids) - 2.0 * (self.centroids @ q) + float(q @ q)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def members(self, cluster_ids):
+        if not len(cluster_ids):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._order[self._bounds[c]:self._bounds[c + 1]] for c in cluster_ids])
+
+    def add(self, vectors, chunk=1024):
+        """Assign new rows (appended after the clustered ones) to people."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, 128)
+        if not len(vectors):
+            return
+        new_labels = np.empty(len(vectors), dtype=np.int32)
+        # working copies with spare capacity, grown by doubling; rows [0, k) are live
+        k = len(self.centroids)
+        centroids = np.empty((max(2 * k, k + min(len(vectors), chunk)), 128), dtype=np.float32)
+        centroids[:k] = self.centroids
+        counts = np.zeros(len(centroids), dtype=np.int64)
+        counts[:k] = self.counts
+        for start in range(0, len(vectors), chunk):
+            block = vectors[start:start + chunk]
+            if k + len(block) > len(centroids):
+                size = max(2 * len(centroids), k + len(block))
+                centroids = np.concatenate([centroids, np.empty((size - len(centroids), 128), np.float32)])
+                counts = np.concatenate([counts, np.zeros(size - len(counts), np.int64)])
+            # faces close to an existing person join in one vector step...
+            if k:
+                c = centroids[:k]
+                d2 = (np.einsum("ij,ij->i", c, c)[None, :] - 2.0 * (block @ c.T)
+                      + np.einsum("ij,ij->i", block, block)[:, None])
+                nearest = np.argmin(d2, axis=1)
+                joined = np.sqrt(np.maximum(d2[np.arange(len(block)), nearest], 0)) <= self.radius
+            else:
+                nearest = np.zeros(len(block), dtype=np.int64)
+                joined = np.zeros(len(block), dtype=bool)
+            for i in np.flatnonzero(joined):
+                j = nearest[i]
+                counts[j] += 1
+                centroids[j] += (block[i] - centroids[j]) / counts[j]
+                new_labels[start + i] = j
+            # ...the rest were beyond radius of everyone known before this
+            # block, so each is only compared with people the block started
+            first_new = k
+            for i in np.flatnonzero(~joined):
+                v = block[i]
+                j = -1
+                if k > first_new:
+                    d = np.linalg.norm(centroids[first_new:k] - v, axis=1)
+                    j = int(np.argmin(d))
+                    j = first_new + j if d[j] <= self.radius else -1
+                if j < 0:
+                    j = k
+                    centroids[j] = v
+                    counts[j] = 1
+                    k += 1
+                else:
+                    counts[j] += 1
+                    centroids[j] += (v - centroids[j]) / counts[j]
+                new_labels[start + i] = j
+        self.centroids = centroids[:k].copy()
+        self.counts = counts[:k].copy()
+        self.labels = np.concatenate([self.labels, new_labels])
+        self._reindex()
+
+    def sync(self, matrix):
+        """Cluster any rows of matrix added since the clusters were saved."""
+        if len(matrix) > len(self):
+            self.add(matrix[len(self):])
+
+    def save(self, path):
+        _save_npz(path, centroids=self.centroids, counts=self.counts, labels=self.labels)
+
+    @classmethod
+    def load(cls, path, radius):
+        data = _load_npz(path)
+        try:
+            return cls(data["centroids"], data["counts"], data["labels"], radius)
+        except (TypeError, KeyError, ValueError):
+            return None
+
+def update_clusters(event):
     """
-    List images in Cloudinary folder {event}/known_faces,
-    extract all face encodings from each image (group support),
-    append each face as a separate encoding entry {public_id, url, encoding},
-    save local JSON and upload JSON to Cloudinary.
+    Assign the event's newly stored faces to person clusters and save.
+    Clustering (seconds for a first build of a large event) runs on the
+    memory-mapped rows with no lock held; the exclusive store lock is only
+    taken to swap the file in, after checking that neither the store nor
+    the clusters file was replaced meanwhile. A writer that lost that race
+    starts over from the newer file, which is then nearly up to date.
     """
-    print(f"🔄 Generating encodings for event: {event}")
-    folder_prefix = f"{event}/known_faces"
+    settings = event_settings(event)
+    if not settings["clusters"]:
+        return None
+    path = clusters_path(event)
+    for _ in range(3):
+        seen = _index_inputs(event, path)
+        store = open_encodings_store(event)
+        if store is None:
+            return None
+        matrix = store[0]
+        clusters = PersonClusters.load(path, settings["cluster_radius"])
+        if clusters is None or len(clusters) > len(matrix):
+            clusters = PersonClusters.empty(settings["cluster_radius"])
+        clusters.sync(matrix)
+        with encodings_lock(event):
+            if _index_inputs(event, path) == seen:
+                clusters.save(path)
+                return clusters
+    return None
+
+_index_builds = set()
+_index_builds_lock = threading.Lock()
+
+def _schedule_index_build(stage_name, event, update):
+    """
+    Run update(event) on a background thread, once per index and event at
+    a time, then reload cached matchers in this process with the result.
+    """
+    if PRELOADED and not _background_started:
+        # gunicorn master before the fork (preload_events): no threads here
+        update(event)
+        return
+    key = (stage_name, event)
+    with _index_builds_lock:
+        if key in _index_builds:
+            return
+        _index_builds.add(key)
+
+    def build():
+        try:
+            if update(event) is not None:
+                bump_encodings_version(event)
+        except Exception as e:
+            record_error(stage_name, e, event, logging.WARNING)
+        finally:
+            with _index_builds_lock:
+                _index_builds.discard(key)
+
+    threading.Thread(target=build, name=f"{stage_name}-{event}", daemon=True).start()
+
+def schedule_cluster_build(event):
+    """
+    Cluster the event on a background thread: the first clustering of a
+    large event stored before clusters existed must not hold up a
+    request. The event is searched exactly meanwhile.
+    """
+    _schedule_index_build("store.clusters", event, update_clusters)
+
+# -------------------- ENCODINGS CACHE --------------------
+_encodings_versions = {}
+_encodings_versions_lock = threading.Lock()
+
+def bump_encodings_version(event):
+    """Mark an event's encodings as changed so cached copies are reloaded."""
+    with _encodings_versions_lock:
+        _encodings_versions[event] = _encodings_versions.get(event, 0) + 1
+
+def encodings_stamp(event):
+    """(mtime, size, version) of an event's encodings, None if there are none."""
     try:
-        response = cloudinary.api.resources(
-            prefix=folder_prefix,
+        st = os.stat(local_encoding_path(event))
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, _encodings_versions.get(event, 0))
+
+class EncodingsCache:
+    """
+    Decoded EventMatchers per event, reloaded when the encodings stamp
+    changes and evicted least-recently-used past a memory budget.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # event -> (stamp, matcher, nbytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def get(self, event, loader):
+        stamp = encodings_stamp(event)
+        with self._lock:
+            entry = self._entries.get(event)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(event)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        matcher = loader(event)
+        if stamp is not None:
+            self._put(event, stamp, matcher)
+        return matcher
+
+    def _put(self, event, stamp, matcher):
+        nbytes = matcher_nbytes(matcher)
+        with self._lock:
+            old = self._entries.pop(event, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[event] = (stamp, matcher, nbytes)
+            self.bytes += nbytes
+            # always keep the entry just loaded, even if it alone is over budget
+            while self.bytes > self.budget_bytes and len(self._entries) > 1:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def invalidate(self, event=None):
+        with self._lock:
+            if event is None:
+                self._entries.clear()
+                self.bytes = 0
+            else:
+                old = self._entries.pop(event, None)
+                if old is not None:
+                    self.bytes -= old[2]
+
+    def events(self):
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions,
+                "bytes": self.bytes,
+                "budget_bytes": self.budget_bytes,
+                "events": {e: v[2] for e, v in self._entries.items()},
+            }
+
+def matcher_nbytes(matcher):
+    # arrays plus a rough per-row allowance for the id/url strings
+    # (an mmapped matrix lives in the shared page cache, counted anyway)
+    return (matcher.matrix.nbytes + matcher.sq_norms.nbytes + matcher.url_ids.nbytes
+            + (matcher.ann.nbytes if matcher.ann is not None else 0)
+            + (matcher.clusters.nbytes if matcher.clusters is not None else 0) + 200 * len(matcher))
+
+encodings_cache = EncodingsCache(int(ENCODINGS_CACHE_MB * 1024 * 1024))
+
+def load_event_matcher(event):
+    with stage("encodings_load", event):
+        matcher = EventMatcher.from_store(event)
+    metrics.set("smartpix_event_faces", len(matcher), event=event_label(event))
+    return matcher
+
+def get_event_matcher(event):
+    return encodings_cache.get(event, load_event_matcher)
+
+# -------------------- ENCODING GENERATION (GROUP SUPPORT) --------------------
+CLOUDINARY_PAGE_SIZE = 500
+
+def processed_manifest_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.processed.jsonl")
+
+def load_processed_ids(event):
+    """
+    public_ids already run through face detection for an event, including
+    images where no face was found. Faces already in the store count too,
+    so events encoded before the manifest existed are not redone.
+    """
+    if not os.path.exists(local_encoding_path(event)):
+        migrate_json_encodings(event)
+    processed = set()
+    with encodings_lock(event, shared=True):
+        try:
+            with open(processed_manifest_path(event), "r") as f:
+                for line in f:
+                    try:
+                        processed.add(json.loads(line)[0])
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        processed.update(pubid for pubid, _, _ in _read_meta(event))
+    return processed
+
+def record_processed(event, results):
+    """Append [(public_id, faces_found)] to the event's processed manifest."""
+    if not results:
+        return
+    with encodings_lock(event):
+        with open(processed_manifest_path(event), "a") as f:
+            f.writelines(json.dumps([pubid, faces]) + "\n" for pubid, faces in results)
+
+def list_event_resources(event):
+    """Yield every image in {event}/known_faces, following next_cursor pages."""
+    cursor = None
+    while True:
+        params = dict(
+            prefix=f"{event}/known_faces",
             type="upload",
             resource_type="image",
-            max_results=500
+            max_results=CLOUDINARY_PAGE_SIZE
         )
-        resources = response.get("resources", [])
-    except Exception as e:
-        print("❌ Cloudinary list error:", e)
-        return False
+        if cursor:
+            params["next_cursor"] = cursor
+        with cloudinary_call("list"):
+            response = cloudinary.api.resources(**params)
+        yield from response.get("resources", [])
+        cursor = response.get("next_cursor")
+        if not cursor:
+            break
 
-    existing = load_local_encodings(event)
-    existing_pubid_url_pairs = {(item.get("public_id"), item.get("face_index", 0)) for item in existing}
-    updated_list = existing[:]  # keep existing entries
+def failures_log_path(event):
+    return os.path.join(ENCODINGS_DIR, f"{event}.failures.jsonl")
 
-    added = 0
-    for res in resources:
-        pubid = res.get("public_id")
-        url = res.get("secure_url") or res.get("url")
-        if not pubid or not url:
-            continue
+def record_failures(event, failures):
+    """Append [(public_id, url, error)] to the event's failure log."""
+    if not failures:
+        return
+    now = int(time.time())
+    with encodings_lock(event):
+        with open(failures_log_path(event), "a") as f:
+            f.writelines(
+                json.dumps({"public_id": pubid, "url": url, "error": str(err), "at": now}) + "\n"
+                for pubid, url, err in failures
+            )
+
+def encode_image_bytes(data, profile="balanced"):
+    """Decode one image and return all its face encodings (runs in a worker process)."""
+    with stage_context("ingest"):
+        with stage("decode"):
+            img = face_recognition.load_image_file(BytesIO(data))
+        return [enc.astype(np.float32) for enc in detect_and_encode(img, profile)]
+
+def _timed_encode(data, profile):
+    # worker processes keep their own metrics, so the time travels back with the result
+    t0 = time.perf_counter()
+    encs = encode_image_bytes(data, profile)
+    return encs, time.perf_counter() - t0
+
+class DownloadError(Exception):
+    pass
+
+def _encode_executor(n_images):
+    """Process pool sized to the cores; inline thread for tiny batches."""
+    workers = min(ENCODE_WORKERS, n_images)
+    if workers <= 1:
+        return ThreadPoolExecutor(max_workers=1), 1
+    # spawn, not fork: this process runs request, pool and background
+    # threads, and a child forked while one of them holds a lock (logging,
+    # metrics, the HTTP pool) deadlocks. Each worker imports the app and
+    # loads the models once, then encodes its share of the batch.
+    ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_encode_worker_init), workers
+
+def _encode_worker_init():
+    # nothing scrapes a worker process; keep its stage() timings off the metrics lock
+    metrics.enabled = False
+
+def run_ingest_pipeline(todo, profile="balanced", on_result=None, event=None):
+    """
+    Download images on a thread pool over the pooled HTTP session and run
+    face detection/encoding on a process pool, with a bounded queue in
+    between so at most INGEST_QUEUE_SIZE downloaded images wait in memory.
+
+    todo is [(public_id, url)], profile a DETECTION_PROFILES name. on_result(public_id, url, encs, error) is
+    called once per image as it finishes; event only labels the metrics. Returns (results, failures):
+    results [(public_id, url, encs)], failures [(public_id, url, error)]
+    where error is a DownloadError or the decode/encode exception.
+    """
+    results, failures = [], []
+    if not todo:
+        return results, failures
+
+    work = queue.Queue()
+    for item in todo:
+        work.put(item)
+    downloaded = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    finished = object()
 
-        # Download image once
+    def downloader():
+        while True:
+            try:
+                pubid, url = work.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                with stage("ingest.download", event), cloudinary_call("image_get"):
+                    r = HTTP.get(url, timeout=20)
+                    if r.status_code != 200:
+                        raise DownloadError(f"HTTP {r.status_code}")
+                    data = r.content
+                downloaded.put((pubid, url, data, None))
+            except Exception as e:
+                err = e if isinstance(e, DownloadError) else DownloadError(str(e))
+                downloaded.put((pubid, url, None, err))
+        downloaded.put(finished)
+
+    n_download = min(DOWNLOAD_WORKERS, len(todo))
+    for _ in range(n_download):
+        threading.Thread(target=downloader, daemon=True).start()
+
+    def collect(fut):
+        pubid, url = pending.pop(fut)
         try:
-            r = requests.get(url, timeout=20)
-            if r.status_code != 200:
-                print("⚠️ Failed to download image:", url)
-                continue
-            img = face_recognition.load_image_file(BytesIO(r.content))
-            encs = face_recognition.face_encodings(img)
-            if not encs:
-                print("⚠️ No faces detected in image:", pubid)
-                continue
-            # Store ALL faces found in the image (group support)
-            for idx, enc in enumerate(encs):
-                # avoid duplicates (public_id + index)
-                key = (pubid, idx)
-                if key in existing_pubid_url_pairs:
-                    continue
-                item = {
-                    "public_id": pubid,
-                    "face_index": idx,
-                    "url": url,
-                    "encoding": enc.tolist()
-                }
-                updated_list.append(item)
-                added += 1
-            if encs:
-                print(f"✔️ Added {len(encs)} faces from {pubid}")
+            encs, seconds = fut.result()
         except Exception as e:
-            print("⚠️ Error processing image", pubid, e)
-            continue
+            metrics.inc("smartpix_errors_total", stage="ingest.encode", event=label)
+            failures.append((pubid, url, e))
+            if on_result:
+                on_result(pubid, url, None, e)
+            return
+        metrics.observe("smartpix_stage_seconds", seconds, stage="ingest.encode", event=label)
+        results.append((pubid, url, encs))
+        if on_result:
+            on_result(pubid, url, encs, None)
+
+    label = event_label(event)
+    pending = {}
+    executor, n_encode = _encode_executor(len(todo))
+    with executor:
+        done_downloaders = 0
+        while done_downloaders < n_download or pending:
+            if done_downloaders < n_download and len(pending) < 2 * n_encode:
+                item = downloaded.get()
+                if item is finished:
+                    done_downloaders += 1
+                    continue
+                pubid, url, data, err = item
+                if err is not None:
+                    failures.append((pubid, url, err))
+                    if on_result:
+                        on_result(pubid, url, None, err)
+                    continue
+                pending[executor.submit(_timed_encode, data, profile)] = (pubid, url)
+                for fut in [f for f in pending if f.done()]:
+                    collect(fut)
+            else:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    collect(fut)
+    return results, failures
+
+_unsynced_events = set()
+_unsynced_lock = threading.Lock()
+
+def push_encodings_if_changed(event):
+    """Publish the event's new faces as a delta shard if any were added since the last push."""
+    with _unsynced_lock:
+        if event not in _unsynced_events:
+            return None
+        _unsynced_events.discard(event)
+    version = publish_encodings(event)
+    if version is None:
+        with _unsynced_lock:
+            _unsynced_events.add(event)
+        return False
+    return version
+
+def add_event_faces(event, items, publish=True):
+    """
+    Append face entries to the event's store and bring its indexes up to
+    date. publish=False for faces that came from the remote.
+    """
+    with stage("store.append", event):
+        added = append_local_encodings(event, items)
+    if added is None:
+        return False
+    if not added:
+        return True
+    metrics.inc("smartpix_faces_added_total", added, event=event_label(event),
+                source="local" if publish else "remote")
+    if publish:
+        with _unsynced_lock:
+            _unsynced_events.add(event)
+    # exact search still works without these, and the matcher catches up
+    # on rows they miss, so failures are not fatal
+    try:
+        with stage("store.ann_index", event):
+            update_ann_index(event, background=True)
+    except Exception as e:
+        record_error("store.ann_index", e, event, logging.WARNING)
+    if event_settings(event)["clusters"] and not os.path.exists(clusters_path(event)):
+        schedule_cluster_build(event)
+        return True
+    try:
+        with stage("store.clusters", event):
+            update_clusters(event)
+    except Exception as e:
+        record_error("store.clusters", e, event, logging.WARNING)
+    return True
+
+def generate_encodings_for_event(event, job=None):
+    """
+    Reconciliation pass (photos normally get encoded at upload time, see
+    record_uploaded_faces): list images in Cloudinary folder {event}/known_faces (all pages),
+    skip public_ids already in the processed manifest, then download and
+    encode the new ones through run_ingest_pipeline (group support: each
+    face is a separate entry {public_id, face_index, url, encoding}),
+    append them to the local store and publish them (publish_encodings).
+    Failed images go to encodings/<event>.failures.jsonl; download
+    failures are retried on the next run. job (an EncodingJob) receives
+    per-image progress.
+    """
+    log_kv("reconcile started", event=event)
+    processed = load_processed_ids(event)
+    todo = []
+    try:
+        with stage("reconcile.list", event):
+            for res in list_event_resources(event):
+                pubid = res.get("public_id")
+                url = res.get("secure_url") or res.get("url")
+                if pubid and url and pubid not in processed:
+                    todo.append((pubid, url))
+    except Exception as e:
+        record_error("reconcile.list", e, event)
+        if not todo:
+            return False
+    log_kv("reconcile listed", event=event, new=len(todo), processed=len(processed))
+
+    if job:
+        job.begin(len(todo))
+    on_result = (lambda pubid, url, encs, err: job.advance(encs, err)) if job else None
+    profile = event_settings(event)["ingest_profile"]
+    with stage("reconcile.ingest", event):
+        results, failures = run_ingest_pipeline(todo, profile=profile, on_result=on_result, event=event)
+    label = event_label(event)
+    metrics.inc("smartpix_photos_total", len(results), event=label, source="reconcile", outcome="ok")
+    metrics.inc("smartpix_photos_total", len(failures), event=label, source="reconcile", outcome="failed")
 
-    if added > 0:
-        saved = save_local_encodings(event, updated_list)
-        if saved:
-            upload_res = upload_encodings_to_cloud(event)
-            if upload_res:
-                print(f"🎉 Encodings JSON uploaded to Cloudinary for {event}")
-    else:
-        print("ℹ️ No new faces to encode.")
+    new_items = []
+    for pubid, url, encs in results:
+        # Store ALL faces found in the image (group support)
+        for idx, enc in enumerate(encs):
+            new_items.append({
+                "public_id": pubid,
+                "face_index": idx,
+                "url": url,
+                "encoding": enc
+            })
+    if new_items:
+        if not add_event_faces(event, new_items):
+            return False
+    # only mark images processed once their faces are stored; undecodable
+    # images are marked too (-1) so they are not downloaded on every run
+    done = [(pubid, len(encs)) for pubid, _, encs in results]
+    done += [(pubid, -1) for pubid, _, err in failures if not isinstance(err, DownloadError)]
+    record_processed(event, done)
+    record_failures(event, failures)
+    log_kv("reconcile encoded", event=event, images=len(results), faces=len(new_items), failed=len(failures))
+
+    # also publishes faces stored at upload time since the last push
+    with stage("reconcile.publish", event):
+        push_encodings_if_changed(event)
     return True
 
-# -------------------- BACKGROUND (light) --------------------
+# -------------------- BACKGROUND JOBS --------------------
+# Jobs run in the worker that accepted the upload; their snapshots are also
+# written to encodings/jobs/<id>.json so a progress stream served by any
+# worker on the box can follow them.
+JOB_STALE_SECONDS = 600
+
+def job_state_path(job_id):
+    return os.path.join(ENCODINGS_DIR, "jobs", f"{job_id}.json")
+
+def read_job_snapshot(job_id):
+    """Last snapshot another worker wrote for job_id, with its age; None if unknown."""
+    if not job_id or not job_id.isalnum():
+        return None
+    p = job_state_path(job_id)
+    try:
+        with open(p, "r") as f:
+            snap = json.load(f)
+        return snap, time.time() - os.path.getmtime(p)
+    except (OSError, ValueError):
+        return None
+
+class EncodingJob:
+    """
+    One (coalesced) encoding run for an event, with live progress: a full
+    generate_encodings_for_event reconcile, or just pushing faces already
+    encoded at upload time to Cloudinary.
+    """
+
+    def __init__(self, event, due, reconcile=True):
+        self.id = uuid.uuid4().hex[:12]
+        self.event = event
+        self.reconcile = reconcile
+        self.status = "queued"
+        self.created = time.time()
+        self.due = due
+        self.started = None
+        self.finished = None
+        self.requests = 1
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.faces = 0
+        self.error = None
+        self._persisted = 0.0
+
+    def begin(self, total):
+        self.total = total
+        self.persist(force=True)
+
+    def advance(self, encs, err):
+        self.done += 1
+        if err is not None:
+            self.failed += 1
+        else:
+            self.faces += len(encs)
+        self.persist()
+
+    def persist(self, force=False):
+        """Write the snapshot for the other workers (at most once a second unless forced)."""
+        now = time.time()
+        if not force and now - self._persisted < 1.0:
+            return
+        self._persisted = now
+        p = job_state_path(self.id)
+        tmp = f"{p}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, p)
+        except OSError as e:
+            record_error("job.persist", e, self.event, logging.WARNING)
+
+    def snapshot(self):
+        now = self.finished or time.time()
+        elapsed = now - self.started if self.started else 0.0
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.done, 0)
+        return {
+            "job": self.id,
+            "event": self.event,
+            "status": self.status,
+            "progress": self.done,
+            "total": self.total,
+            "failed": self.failed,
+            "faces": self.faces,
+            "images_per_sec": round(rate, 2),
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+            "elapsed_seconds": round(elapsed, 1),
+            "done": self.status in ("done", "failed"),
+            "error": self.error,
+        }
+
+class EncodingScheduler:
+    """
+    Queue of per-event encoding jobs, run one at a time by background_worker.
+    A request for an event that already has a queued job joins that job
+    and pushes its start back by the debounce window, so a burst of
+    uploads becomes a single incremental run.
+    """
+
+    def __init__(self, debounce, keep_finished=200):
+        self.debounce = debounce
+        self.keep_finished = keep_finished
+        self._jobs = OrderedDict()  # id -> job
+        self._queued = {}  # event -> queued job
+        self._cond = threading.Condition()
+
+    def request(self, event, reconcile=True):
+        with self._cond:
+            due = time.time() + self.debounce
+            job = self._queued.get(event)
+            if job is not None:
+                job.due = due
+                job.requests += 1
+                job.reconcile = job.reconcile or reconcile
+                return job
+            job = EncodingJob(event, due, reconcile)
+            self._queued[event] = job
+            self._jobs[job.id] = job
+            self._prune()
+            self._cond.notify()
+        job.persist(force=True)
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def counts(self):
+        """{status: number of jobs} over the jobs still tracked."""
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+    def latest_for(self, event):
+        with self._cond:
+            for job in reversed(self._jobs.values()):
+                if job.event == event:
+                    return job
+        return None
+
+    def run_next(self, timeout):
+        """Wait up to timeout for a due job and run it. Returns the job or None."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                job = min(self._queued.values(), key=lambda j: j.due, default=None)
+                if job is not None and job.due <= now:
+                    del self._queued[job.event]
+                    job.status = "running"
+                    job.started = now
+                    break
+                wake = min(deadline, job.due) if job is not None else deadline
+                if now >= deadline:
+                    return None
+                self._cond.wait(wake - now)
+        job.persist(force=True)
+        try:
+            with stage("job.reconcile" if job.reconcile else "job.publish", job.event):
+                if job.reconcile:
+                    ok = generate_encodings_for_event(job.event, job=job)
+                else:
+                    ok = push_encodings_if_changed(job.event) is not False
+            job.status = "done" if ok else "failed"
+            if not ok:
+                job.error = "encoding run failed (see logs)"
+        except Exception as e:
+            # already counted by stage()
+            log_kv("encoding job failed", logging.ERROR, event=job.event, job=job.id, error=e)
+            job.status = "failed"
+            job.error = str(e)
+        job.finished = time.time()
+        job.persist(force=True)
+        return job
+
+    def _prune(self):
+        finished = [j.id for j in self._jobs.values() if j.status in ("done", "failed")]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[job_id]
+            try:
+                os.remove(job_state_path(job_id))
+            except OSError:
+                pass
+
+encoding_scheduler = EncodingScheduler(ENCODE_DEBOUNCE_SECONDS)
+
 def background_worker(interval=600):
+    last_poll = time.time()
     while True:
-        # placeholder: could periodically refresh encodings, but avoid heavy ops
-        time.sleep(interval)
+        encoding_scheduler.run_next(timeout=min(interval, SYNC_POLL_SECONDS))
+        if time.time() - last_poll >= SYNC_POLL_SECONDS:
+            last_poll = time.time()
+            # keep events this worker is serving fresh (mostly 304s)
+            for event in encodings_cache.events():
+                try:
+                    pull_encodings(event)
+                except Exception as e:
+                    record_error("sync.poll", e, event, logging.WARNING)
+
+_background_started = False
+
+def start_background_threads():
+    """Start background_worker once per process (after the fork when preloaded)."""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    threading.Thread(target=background_worker, name="background", daemon=True).start()
+
+# -------------------- RESULT STORE --------------------
+class ResultStore:
+    """
+    Match results on disk under a short random id, so every worker on the
+    box can serve them. Entries older than the TTL are treated as gone
+    and swept on later writes.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, result_id):
+        return os.path.join(self.directory, f"{result_id}.json")
+
+    def put(self, event, ranked):
+        """Store [(url, distance)] (best first); returns the result id."""
+        result_id = uuid.uuid4().hex[:16]
+        tmp = self._path(result_id) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"event": event, "created": time.time(),
+                       "matches": [[url, round(dist, 4)] for url, dist in ranked]}, f)
+        os.replace(tmp, self._path(result_id))
+        self._sweep()
+        return result_id
+
+    def get(self, result_id):
+        if not result_id or not result_id.isalnum():
+            return None
+        try:
+            with open(self._path(result_id), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - data.get("created", 0) > self.ttl:
+            return None
+        return data
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+result_store = ResultStore(RESULTS_DIR, RESULTS_TTL_SECONDS)
+
+def thumbnail_url(url):
+    """Cloudinary delivery URL for a small, face-cropped thumbnail of an image."""
+    marker = "/image/upload/"
+    if marker not in url:
+        return url
+    return url.replace(marker, f"{marker}{THUMB_TRANSFORM}/", 1)
+
+def session_result_urls():
+    data = result_store.get(request.args.get("result") or session.get("result_id"))
+    return [url for url, _ in data["matches"]] if data else []
+
+# -------------------- SELFIE POOL --------------------
+selfie_pool = ThreadPoolExecutor(max_workers=SELFIE_WORKERS, thread_name_prefix="selfie")
+_selfie_slots = threading.BoundedSemaphore(SELFIE_WORKERS + SELFIE_QUEUE)
+
+def encode_selfie(stream, profile, event=None, trace=None):
+    """Selfie encodings; stages are timed as selfie.* into event's metrics and the request trace."""
+    with stage_context("selfie", event, trace):
+        with stage("decode"):
+            img = decode_image(stream, SELFIE_MAX_DIM)
+        return detect_and_encode(img, profile)
+
+# -------------------- PHOTOGRAPHER UPLOADS --------------------
+upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+
+# The SDK keeps one urllib3 pool for all uploads; size it so parallel
+# uploads each keep their keep-alive connection instead of reconnecting.
+if hasattr(cloudinary.uploader, "_http"):
+    cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+        cloudinary.config(), dict(cloudinary.CERT_KWARGS, maxsize=max(UPLOAD_WORKERS, 1))
+    )
+
+def upload_event_photo(event, stream, filename=None, encode=True, trace=None):
+    """
+    Resize one photo, encode its faces from the decoded image (so they
+    never have to be downloaded back) and upload it to {event}/known_faces.
+    Returns a per-file result dict with timings; never raises. The
+    encodings ride along under "encodings" for record_uploaded_faces.
+    trace is the request's stage list when running on upload_pool.
+    """
+    result = {"filename": filename, "ok": False}
+    t0 = time.perf_counter()
+    try:
+        with stage_context("upload", event, trace):
+            with stage("decode"):
+                img = load_image(stream, UPLOAD_MAX_DIM)
+            t1 = time.perf_counter()
+            if encode:
+                try:
+                    encs = detect_and_encode(np.asarray(img), event_settings(event)["ingest_profile"])
+                    result["encodings"] = [enc.astype(np.float32) for enc in encs]
+                except Exception as e:
+                    # left for the reconcile pass
+                    result["encode_error"] = str(e)
+            t2 = time.perf_counter()
+            with stage("cloudinary"):
+                buffer = BytesIO()
+                img.save(buffer, format="JPEG", quality=85)
+                buffer.seek(0)
+                with cloudinary_call("upload"):
+                    res = cloudinary.uploader.upload(
+                        buffer,
+                        folder=f"{event}/known_faces",
+                        resource_type="image"
+                    )
+            t3 = time.perf_counter()
+        result.update(
+            ok=True,
+            public_id=res.get("public_id"),
+            url=res.get("secure_url") or res.get("url"),
+            resize_ms=round((t1 - t0) * 1000, 1),
+            encode_ms=round((t2 - t1) * 1000, 1),
+            upload_ms=round((t3 - t2) * 1000, 1),
+        )
+    except Exception as e:
+        result["error"] = str(e)
+        log_kv("upload failed", logging.ERROR, event=event, filename=filename, error=e)
+    metrics.inc("smartpix_photos_total", event=event_label(event), source="upload",
+                outcome="ok" if result["ok"] else "failed")
+    result["total_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return result
+
+def record_uploaded_faces(event, results):
+    """
+    Store faces encoded at upload time and mark those photos processed.
+    Pops "encodings" from each result (leaving a "faces" count). Returns
+    True if some uploaded photo still needs the reconcile pass.
+    """
+    items, done = [], []
+    needs_reconcile = False
+    for r in results:
+        encs = r.pop("encodings", None)
+        if not r["ok"]:
+            continue
+        if encs is None or not r.get("public_id") or not r.get("url"):
+            needs_reconcile = True
+            continue
+        r["faces"] = len(encs)
+        done.append((r["public_id"], len(encs)))
+        for idx, enc in enumerate(encs):
+            items.append({"public_id": r["public_id"], "face_index": idx, "url": r["url"], "encoding": enc})
+    if items and not add_event_faces(event, items):
+        return True
+    record_processed(event, done)
+    return needs_reconcile
+
+# -------------------- IMAGE CACHE --------------------
+class ImageCache:
+    """
+    Size-bounded on-disk LRU of proxied images, keyed by a hash of the URL.
+    Each image has a <key>.json sidecar with its content type and ETag;
+    file mtimes are bumped on hit and the oldest files go first.
+    """
+
+    def __init__(self, directory, budget_bytes):
+        self.directory = os.path.abspath(directory)
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._bytes = None  # scanned lazily
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _key_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def lookup(self, url):
+        """(path, meta) of a cached image, or None."""
+        p = self._key_path(url)
+        try:
+            with open(p + ".json", "r") as f:
+                meta = json.load(f)
+            os.utime(p)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self.hits += 1
+        return p, meta
+
+    def fetch(self, url):
+        """
+        Iterator over the image's bytes: from disk on a hit, otherwise
+        streamed from the origin through the pooled session and written
+        to the cache on the way. Raises DownloadError if the origin fails.
+        """
+        hit = self.lookup(url)
+        if hit is not None:
+            return self._read(hit[0]), hit[1]
+        with self._lock:
+            self.misses += 1
+        with cloudinary_call("image_get"):
+            r = HTTP.get(url, timeout=20, stream=True)
+            if r.status_code != 200:
+                r.close()
+                raise DownloadError(f"HTTP {r.status_code}")
+        meta = {"content_type": r.headers.get("Content-Type", "image/jpeg"),
+                "length": r.headers.get("Content-Length")}
+        return self._tee(url, r, meta), meta
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+                yield chunk
+
+    def _tee(self, url, r, meta):
+        p = self._key_path(url)
+        tmp = f"{p}.{uuid.uuid4().hex}.part"
+        digest = hashlib.sha1()
+        size = 0
+        complete = False
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            r.close()
+            if complete:
+                os.replace(tmp, p)
+                with open(p + ".json", "w") as f:
+                    json.dump({"content_type": meta["content_type"], "etag": digest.hexdigest(),
+                               "length": size, "url": url}, f)
+                self._account(size)
+            else:
+                # client went away mid-stream
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def _account(self, added):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(e.stat().st_size for e in os.scandir(self.directory) if e.is_file())
+            else:
+                self._bytes += added
+            if self._bytes <= self.budget_bytes:
+                return
+            # evict least recently used down to 90% of the budget
+            files = [e for e in os.scandir(self.directory)
+                     if e.is_file() and not e.name.endswith((".json", ".part"))]
+            files.sort(key=lambda e: e.stat().st_mtime)
+            self._bytes = sum(e.stat().st_size for e in os.scandir(self.directory) if e.is_file())
+            for entry in files:
+                if self._bytes <= 0.9 * self.budget_bytes:
+                    break
+                for path in (entry.path, entry.path + ".json"):
+                    try:
+                        self._bytes -= os.path.getsize(path)
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "bytes": self._bytes, "budget_bytes": self.budget_bytes}
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, int(IMAGE_CACHE_MB * 1024 * 1024))
+
+def proxy_allowed(url):
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    return parsed.scheme in ("http", "https") and parsed.hostname in DOWNLOAD_HOSTS
+
+class _ZipSink:
+    """Write-only, unseekable file object that buffers zip output between yields."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
 
-threading.Thread(target=background_worker, daemon=True).start()
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+def stream_zip(urls):
+    """Yield a ZIP of the given images chunk by chunk, never holding it in memory."""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+        for i, url in enumerate(urls, 1):
+            try:
+                chunks, _ = image_cache.fetch(url)
+            except Exception as e:
+                record_error("download_all.fetch", e, level=logging.WARNING, url=url)
+                continue
+            ext = os.path.splitext(urlparse(url).path)[1] or ".jpg"
+            with zf.open(f"AshiSmartPix_{i:03d}{ext}", "w") as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
 
 # -------------------- ROUTES --------------------
 @app.route("/")
@@ -251,33 +2486,35 @@ def event_upload():
     event = session["event"]
     
     if request.method == "POST":
-        files = request.files.getlist("files[]")
-        uploaded = 0
-        
-        for file in files:
-            if file and file.filename:
-                try:
-                    img = Image.open(file.stream)
-                    img = img.convert("RGB")
-                    img.thumbnail((2048, 2048))
-                    buffer = BytesIO()
-                    img.save(buffer, format="JPEG", quality=85)
-                    buffer.seek(0)
-                    cloudinary.uploader.upload(
-                        buffer,
-                        folder=f"{event}/known_faces",
-                        resource_type="image"
-                    )
-                    uploaded += 1
-                except Exception as e:
-                    flash(f"Upload failed for {file.filename}: {e}", "danger")
+        files = [f for f in request.files.getlist("files[]") if f and f.filename]
+        t0 = time.perf_counter()
+        trace = request_trace()
+        with stage("upload.batch", event):
+            report = list(upload_pool.map(
+                lambda f: upload_event_photo(event, f.stream, f.filename, trace=trace), files
+            ))
+        elapsed = time.perf_counter() - t0
+        uploaded = sum(1 for r in report if r["ok"])
+        for r in report:
+            if not r["ok"]:
+                flash(f"Upload failed for {r['filename']}: {r['error']}", "danger")
+        log_kv("photos uploaded", event=event, uploaded=uploaded, files=len(report), seconds=elapsed)
+        # stores the faces encoded during upload, and takes the encodings
+        # out of the report (even when every upload failed)
+        with stage("upload.store", event):
+            reconcile = record_uploaded_faces(event, report)
+        job_id = None
         if uploaded > 0:
-            # generate encodings (this will add all faces from group photos)
-            generate_encodings_for_event(event)
-        qr_path, guest_link = generate_qr(event)
+            # the background job pushes them to Cloudinary (and reconciles anything that failed)
+            job_id = encoding_scheduler.request(event, reconcile=reconcile).id
+        with stage("upload.qr", event):
+            qr_path, guest_link = generate_qr(event)
         filename = os.path.basename(qr_path)
-        flash(f"Uploaded {uploaded} images. QR generated.", "success")
-        return render_template("dashboard.html", event=event, filename=filename, guest_link=guest_link)
+        flash(f"Uploaded {uploaded} images in {elapsed:.1f}s. QR generated.", "success")
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({"uploaded": uploaded, "seconds": round(elapsed, 2), "job_id": job_id, "files": report})
+        return render_template("dashboard.html", event=event, filename=filename, guest_link=guest_link,
+                               job_id=job_id, upload_report=report)
     return render_template("event_upload.html", event=event)
 
 #after up
@@ -286,24 +2523,28 @@ def upload_single():
     event = session.get("event")
     file = request.files.get("file")
 
+    if not event:
+        return "Not logged in", 401
     if not file:
         return "No file", 400
 
-    img = Image.open(file.stream)
-    img = img.convert("RGB")
-    img.thumbnail((2048, 2048))
-
-    buffer = BytesIO()
-    img.save(buffer, format="JPEG", quality=85)
-    buffer.seek(0)
-
-    cloudinary.uploader.upload(
-        buffer,
-        folder=f"{event}/known_faces",
-        resource_type="image"
-    )
+    result = upload_event_photo(event, file.stream, file.filename)
+    with stage("upload.store", event):
+        reconcile = record_uploaded_faces(event, [result])
+    if not result["ok"]:
+        return jsonify(result), 500
 
-    return "OK"
+    # debounced: a burst of single uploads becomes one sync job
+    job = encoding_scheduler.request(event, reconcile=reconcile)
+    return jsonify(dict(result, job_id=job.id))
+# Re-scan the Cloudinary folder (e.g. photos added there directly)
+@app.route("/reconcile", methods=["POST"])
+def reconcile():
+    event = session.get("event")
+    if "user" not in session or not event:
+        return "Not logged in", 401
+    job = encoding_scheduler.request(event, reconcile=True)
+    return jsonify({"job_id": job.id})
 ##final---
 @app.route("/upload_complete")
 def upload_complete():
@@ -315,79 +2556,122 @@ def guest(event):
     session["event"] = event
     return render_template("index.html", event=event)
 
-# Selfie upload and fast match (uses precomputed JSON)
+# Selfie upload and fast match (uses precomputed encodings)
 @app.route("/upload/<event>", methods=["POST"])
 def upload_selfie(event):
-    print(f"🔥 Guest selfie upload for event: {event}")
     session["event"] = event
+    label = event_label(event)
 
     file = request.files.get("file")
     if not file:
-        print("❌ No selfie file received")
+        log_kv("selfie missing", logging.WARNING, event=event)
+        metrics.inc("smartpix_selfies_total", event=label, outcome="no_file")
         flash("Please upload a selfie.", "warning")
         return redirect(url_for("guest", event=event))
 
-    os.makedirs(UPLOADS_DIR, exist_ok=True)
-    selfie_path = os.path.join(UPLOADS_DIR, "selfie.jpg")
-    file.save(selfie_path)
-    print("✅ Selfie saved:", selfie_path)
+    # admission control: shed load instead of queueing unbounded CPU work
+    if not _selfie_slots.acquire(blocking=False):
+        log_kv("selfie pool busy", logging.WARNING, event=event, retry_after=SELFIE_RETRY_AFTER)
+        metrics.inc("smartpix_selfies_total", event=label, outcome="busy")
+        resp = jsonify({"busy": True, "retry_after": SELFIE_RETRY_AFTER})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(SELFIE_RETRY_AFTER)
+        return resp
 
-    # encode selfie
+    # encode selfie straight from the request stream (no temp file)
     try:
-        selfie_img = face_recognition.load_image_file(selfie_path)
-        selfie_encs = face_recognition.face_encodings(selfie_img)
+        with stage("selfie.queue_and_encode", event):
+            selfie_encs = selfie_pool.submit(
+                encode_selfie, file.stream, event_settings(event)["selfie_profile"], event, request_trace()
+            ).result()
     except Exception as e:
-        print("❌ Error reading selfie:", e)
+        log_kv("selfie unreadable", logging.WARNING, event=event, error=e)
         selfie_encs = []
+    finally:
+        _selfie_slots.release()
 
     if not selfie_encs:
-        print("😕 No face found in selfie.")
-        session["matches"] = []
+        log_kv("no face in selfie", event=event)
+        metrics.inc("smartpix_selfies_total", event=label, outcome="no_face")
+        session["result_id"] = result_store.put(event, [])
         return redirect(url_for("result"))
 
     selfie_enc = selfie_encs[0]
-    print("🧠 Selfie encoding length:", len(selfie_enc))
-
-    # Load encodings (local or cloud)
-    enc_list = load_local_encodings(event)
-    if not enc_list:
-        print("⚠️ Local encodings missing, trying Cloudinary download...")
-        enc_list = download_encodings_from_cloud(event) or []
-        if not enc_list:
-            print("❌ No encodings available. Photographer needs to upload images first.")
-            session["matches"] = []
-            return redirect(url_for("result"))
 
-    print(f"🔍 Comparing against {len(enc_list)} precomputed encodings...")
-    matches = []
-    for item in enc_list:
+    # Load encodings (cached, local or cloud)
+    with stage("selfie.encodings", event):
+        matcher = get_event_matcher(event)
+    if not len(matcher):
+        log_kv("local encodings missing, pulling", logging.WARNING, event=event)
         try:
-            known_enc = np.array(item["encoding"])
-            url = item.get("url")
-            is_match = face_recognition.compare_faces([known_enc], selfie_enc, tolerance=0.55)
-            if is_match and is_match[0]:
-                # add url only once
-                if url not in matches:
-                    matches.append(url)
+            with stage("selfie.cloud_fallback", event):
+                pulled = pull_encodings(event)
         except Exception as e:
-            print("⚠️ Compare error:", e)
-            continue
+            # the remote refused or failed the read (counted by stage)
+            log_kv("encodings pull failed", logging.WARNING, event=event, error=e)
+            pulled = None
+        if not pulled:
+            log_kv("no encodings available", logging.WARNING, event=event)
+            metrics.inc("smartpix_selfies_total", event=label, outcome="no_encodings")
+            session["result_id"] = result_store.put(event, [])
+            return redirect(url_for("result"))
+        matcher = get_event_matcher(event)
 
-    session["matches"] = matches
-    print(f"🎯 Found {len(matches)} matches.")
+    settings = event_settings(event)
+    with stage("selfie.match", event):
+        ranked = matcher.match(
+            selfie_enc, tolerance=settings["tolerance"], top_k=settings["top_k"], nprobe=settings["ann_nprobe"],
+            margin=settings["cluster_margin"] if settings["clusters"] else None, refine=settings["cluster_refine"]
+        )
+    with stage("selfie.store_result", event):
+        session["result_id"] = result_store.put(event, ranked)
+    metrics.inc("smartpix_selfies_total", event=label, outcome="matched" if ranked else "no_match")
+    log_kv("selfie matched", event=event, faces=len(matcher), matches=len(ranked))
     return redirect(url_for("result"))
 
-# Result page
+# Result page (photos are loaded page by page from /api/matches)
 @app.route("/result")
 def result():
     try:
-        matches = session.get("matches", [])
-        print("✅ Sending matches to result.html:", len(matches))
-        return render_template("result.html", matches=matches)
+        result_id = session.get("result_id")
+        data = result_store.get(result_id)
+        total = len(data["matches"]) if data else 0
+        return render_template("result.html", result_id=result_id if data else None, total=total)
     except Exception as e:
-        print("❌ Error rendering result page:", e)
+        record_error("result", e, result_id=session.get("result_id"))
         return "Server error", 500
-    
+
+# Paginated, distance-ranked matches: ?cursor=<opaque>&limit=<n>
+@app.route("/api/matches/<result_id>")
+def api_matches(result_id):
+    data = result_store.get(result_id)
+    if data is None:
+        return jsonify({"error": "result not found or expired"}), 404
+    try:
+        start = int(request.args.get("cursor") or 0)
+        limit = min(max(int(request.args.get("limit") or RESULTS_PAGE_SIZE), 1), 100)
+    except ValueError:
+        return jsonify({"error": "bad cursor or limit"}), 400
+    if start < 0:
+        return jsonify({"error": "bad cursor or limit"}), 400
+    page = data["matches"][start:start + limit]
+    end = start + len(page)
+    return jsonify({
+        "result_id": result_id,
+        "event": data["event"],
+        "total": len(data["matches"]),
+        "items": [
+            {
+                "url": url,
+                "thumb": thumbnail_url(url),
+                "distance": dist,
+                "download": url_for("download_image", url=url),
+            }
+            for url, dist in page
+        ],
+        "next_cursor": str(end) if end < len(data["matches"]) else None,
+    })
+
 #link----- 
 @app.route("/dashboard", methods=["GET", "POST"])
 def dashboard():
@@ -416,39 +2700,175 @@ def dashboard():
         guest_link=guest_link
     )
 
+# Encodings cache counters (for sizing ENCODINGS_CACHE_MB)
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify(encodings_cache.stats())
+
+# Prometheus scrape endpoint (this process only)
+@app.route("/metrics")
+def metrics_endpoint():
+    for name, cache in (("encodings", encodings_cache), ("images", image_cache)):
+        stats = cache.stats()
+        metrics.set("smartpix_cache_hits_total", stats["hits"], cache=name)
+        metrics.set("smartpix_cache_misses_total", stats["misses"], cache=name)
+        metrics.set("smartpix_cache_evictions_total", stats["evictions"], cache=name)
+        if stats["bytes"] is not None:
+            metrics.set("smartpix_cache_bytes", stats["bytes"], cache=name)
+    counts = encoding_scheduler.counts()
+    for status in ("queued", "running", "done", "failed"):
+        metrics.set("smartpix_encoding_jobs", counts.get(status, 0), status=status)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # Download QR
 @app.route("/download_qr/<filename>")
 def download_qr(filename):
     return send_from_directory(QR_DIR, filename, as_attachment=True)
 
-# Download image (proxy)
+# Download image (proxy): cached on disk, streamed, ETag / Range aware
 @app.route("/download")
 def download_image():
     img_url = request.args.get("url")
     if not img_url:
         return "No URL specified", 400
+    if not proxy_allowed(img_url):
+        return "URL not allowed", 400
     try:
-        r = requests.get(img_url, timeout=20)
-        if r.status_code != 200:
-            return "Could not fetch image", 500
-        # use original filename if possible
-        return send_file(BytesIO(r.content), mimetype="image/jpeg", as_attachment=True, download_name="AshiSmartPix.jpg")
+        with stage("download.lookup"):
+            hit = image_cache.lookup(img_url)
+        if hit is None and request.range is not None:
+            # fill the cache first so the range can be served from disk
+            with stage("download.fill"):
+                chunks, _ = image_cache.fetch(img_url)
+                for _ in chunks:
+                    pass
+            hit = image_cache.lookup(img_url)
+        if hit is not None:
+            path, meta = hit
+            return send_file(path, mimetype=meta["content_type"], as_attachment=True,
+                             download_name="AshiSmartPix.jpg", conditional=True,
+                             etag=meta["etag"], max_age=86400)
+        with stage("download.origin"):
+            chunks, meta = image_cache.fetch(img_url)
+
+        def relay():
+            # the body is sent after the request is logged; time it separately
+            with stage("download.stream"):
+                yield from chunks
+        resp = Response(stream_with_context(relay()), mimetype=meta["content_type"])
+        resp.headers["Content-Disposition"] = "attachment; filename=AshiSmartPix.jpg"
+        if meta.get("length"):
+            resp.headers["Content-Length"] = meta["length"]
+        return resp
+    except DownloadError as e:
+        log_kv("download failed", logging.WARNING, url=img_url, error=e)
+        return "Could not fetch image", 500
     except Exception as e:
-        print("❌ Download error:", e)
+        record_error("download", e, url=img_url)
         return "Server error", 500
 
-# Progress SSE (optional)
+# Download all matches (session result, or ?result=<id>) as one streamed ZIP
+@app.route("/download_all")
+def download_all():
+    urls = [u for u in session_result_urls() if proxy_allowed(u)]
+    if not urls:
+        return "No photos to download", 404
+    def relay():
+        with stage("download_all.stream"):
+            yield from stream_zip(urls)
+    resp = Response(stream_with_context(relay()), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = "attachment; filename=AshiSmartPix.zip"
+    return resp
+
+# Encoding job progress (SSE): /progress_stream?job=<id>, or the latest job of the session event
 @app.route("/progress_stream")
 def progress_stream():
+    job_id = request.args.get("job")
+    job = encoding_scheduler.get(job_id) if job_id else encoding_scheduler.latest_for(session.get("event"))
+
+    def current():
+        if job is not None:
+            return job.snapshot()
+        # accepted by another worker: follow the snapshots it writes, unless
+        # they stopped changing (that worker went away)
+        found = read_job_snapshot(job_id)
+        if found is None or (not found[0]["done"] and found[1] > JOB_STALE_SECONDS):
+            return None
+        return found[0]
+
     def generate():
-        total = 10
-        for i in range(1, total + 1):
-            yield f"data: {json.dumps({'progress': i, 'total': total})}\n\n"
-            time.sleep(0.2)
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        last = None
+        while True:
+            snap = current()
+            if snap is None:
+                # not a failure: the job may well be running where this worker can't see it
+                unknown = {"job": job_id, "status": "unknown", "done": True, "error": "job status unavailable"}
+                yield f"data: {json.dumps(unknown)}\n\n"
+                return
+            if snap != last:
+                yield f"data: {json.dumps(snap)}\n\n"
+                last = snap
+            if snap["done"]:
+                return
+            time.sleep(0.5)
     return Response(stream_with_context(generate()), mimetype="text/event-stream")
 
+# -------------------- SERVING --------------------
+def warm_up():
+    """
+    Decode, detect and encode a synthetic image once per detection profile
+    in use, so the first real request does not pay for lazy initialisation.
+    Runs on the calling thread (in the master before the fork when preloaded).
+    """
+    t0 = time.perf_counter()
+    profiles = sorted({event_settings(e)[k] for e in [None, *EVENT_SETTINGS]
+                       for k in ("selfie_profile", "ingest_profile")})
+    noise = np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(noise).save(buffer, format="JPEG")
+    with stage_context("warmup"):
+        for profile in profiles:
+            buffer.seek(0)
+            img = decode_image(buffer, SELFIE_MAX_DIM)
+            detect_and_encode(img, profile)
+        # noise has no faces; force a box so the landmark and encoder models run too
+        with stage("encode"):
+            face_recognition.face_encodings(img, known_face_locations=[(140, 420, 340, 220)])
+    log_kv("warmed up", profiles=",".join(profiles), seconds=time.perf_counter() - t0)
+
+def preload_events(events=None):
+    """
+    Load events (default PRELOAD_EVENTS) into encodings_cache, pulling any
+    this box does not have yet. Workers forked afterwards start with them
+    loaded; entries are still reloaded when an event's encodings change.
+    """
+    events = PRELOAD_EVENTS if events is None else events
+    for event in events:
+        try:
+            if not _local_rows(event):
+                pull_encodings(event)
+            faces = len(get_event_matcher(event))
+            log_kv("event preloaded", event=event, faces=faces)
+        except Exception as e:
+            record_error("preload", e, event, logging.WARNING)
+    # connections opened here must not be shared by the forked workers
+    HTTP.close()
+
+# not in the master before the fork (gunicorn post_fork starts them), nor
+# in the spawned encode workers, which import this module too
+if not PRELOADED and multiprocessing.parent_process() is None:
+    start_background_threads()
+
 # -------------------- MAIN --------------------
 if __name__ == "__main__":
-    print("🚀 Ashi SmartPix (GROUP + Cloud JSON) running at http://127.0.0.1:5000")
+    if sys.argv[1:2] == ["migrate"]:
+        # one-time: python ashik.py migrate
+        migrate_all_json_encodings()
+        sys.exit(0)
+    if sys.argv[1:2] == ["ann-report"]:
+        # python ashik.py ann-report <event>: ANN recall vs latency
+        for row in ann_recall_report(sys.argv[2]):
+            print(json.dumps(row))
+        sys.exit(0)
+    log_kv("Ashi SmartPix running", url="http://127.0.0.1:5000")
     app.run(debug=True, threaded=True, use_reloader=False)
@@ -0,0 +1,430 @@
+# bench.py — benchmarks for the hot paths in ashik.py
+#
+# Runs against synthetic events (random unit-norm 128-d encodings, generated
+# photos) and an in-process stand-in for Cloudinary, so it needs no network
+# and no Cloudinary account. Results are JSON, one record per measurement,
+# tagged with the git commit so runs can be compared across commits:
+#
+#   python bench.py                                   # JSON to stdout
+#   python bench.py --sizes 1000,10000,100000 --out bench_output.json
+#   python bench.py --only selfie,download
+#   python bench.py --compare before.json after.json
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from io import BytesIO
+from contextlib import redirect_stdout
+
+# Everything the app writes goes to a scratch dir; set before importing ashik
+# spawned encode workers re-run this module; they reuse the parent's directory
+WORKDIR = os.environ.get("SMARTPIX_BENCH_DIR") or tempfile.mkdtemp(prefix="smartpix-bench-")
+os.environ["SMARTPIX_BENCH_DIR"] = WORKDIR
+os.environ["ENCODINGS_DIR"] = os.path.join(WORKDIR, "encodings")
+os.environ["IMAGE_CACHE_DIR"] = os.path.join(WORKDIR, "image_cache")
+os.environ["RESULTS_DIR"] = os.path.join(WORKDIR, "results")
+os.environ["ENCODINGS_REMOTE"] = "local:" + os.path.join(WORKDIR, "remote")
+os.environ["SYNC_POLL_SECONDS"] = "86400"
+
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from PIL import Image, ImageDraw, ImageOps
+import cloudinary.api
+import cloudinary.uploader
+
+import ashik
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# -------------------- FAKE CLOUDINARY --------------------
+class FakeCloudinary:
+    """In-memory stand-in for cloudinary.uploader / cloudinary.api and the image CDN."""
+
+    HOST = "https://res.cloudinary.com/bench/"
+    BASE = HOST + "image/upload/"
+
+    def __init__(self):
+        self.images = {}  # public_id -> jpeg bytes
+        self.calls = {"upload": 0, "resources": 0, "resource": 0, "fetch": 0}
+
+    def url(self, public_id):
+        return f"{self.BASE}{public_id}.jpg"
+
+    def upload(self, file, folder=None, public_id=None, resource_type="image", **kwargs):
+        self.calls["upload"] += 1
+        data = file.read() if hasattr(file, "read") else open(file, "rb").read()
+        public_id = public_id or f"{folder}/{uuid.uuid4().hex[:20]}"
+        self.images[public_id] = data
+        return {"public_id": public_id, "secure_url": self.url(public_id)}
+
+    def resources(self, prefix="", max_results=500, next_cursor=None, **kwargs):
+        self.calls["resources"] += 1
+        keys = sorted(k for k in self.images if k.startswith(prefix))
+        start = int(next_cursor or 0)
+        page = keys[start:start + max_results]
+        out = {"resources": [{"public_id": k, "secure_url": self.url(k)} for k in page]}
+        if start + max_results < len(keys):
+            out["next_cursor"] = str(start + max_results)
+        return out
+
+    def resource(self, public_id, **kwargs):
+        self.calls["resource"] += 1
+        return {"public_id": public_id, "secure_url": self.url(public_id)}
+
+    def install(self):
+        cloudinary.uploader.upload = self.upload
+        cloudinary.api.resources = self.resources
+        cloudinary.api.resource = self.resource
+        ashik.HTTP.mount(self.HOST, FakeCDNAdapter(self))
+
+class FakeCDNAdapter(BaseAdapter):
+    """requests transport that serves FakeCloudinary images instead of the CDN."""
+
+    def __init__(self, cloud):
+        super().__init__()
+        self.cloud = cloud
+
+    def send(self, request, stream=False, **kwargs):
+        self.cloud.calls["fetch"] += 1
+        public_id = request.url[len(FakeCloudinary.BASE):].rsplit(".", 1)[0]
+        data = self.cloud.images.get(public_id)
+        resp = requests.Response()
+        resp.request = request
+        resp.url = request.url
+        if data is None:
+            resp.status_code = 404
+            resp.raw = BytesIO(b"")
+        else:
+            resp.status_code = 200
+            resp.raw = BytesIO(data)
+            resp.headers = CaseInsensitiveDict({"Content-Type": "image/jpeg", "Content-Length": str(len(data))})
+        return resp
+
+    def close(self):
+        pass
+
+# -------------------- SYNTHETIC DATA --------------------
+def unit_rows(rng, n):
+    x = rng.normal(size=(n, 128)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+def synthetic_encodings(rng, n, faces_per_person=20, spread=0.02, plant=None, planted=30):
+    """
+    n encodings of n / faces_per_person people: unit-norm centres plus
+    per-face noise. With plant (a real selfie encoding), the first
+    `planted` faces belong to that guest so selfie lookups find matches.
+    """
+    people = unit_rows(rng, max(n // faces_per_person, 1))
+    x = people[rng.integers(0, len(people), n)] + rng.normal(0, spread, (n, 128)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    if plant is not None:
+        k = min(planted, n)
+        x[:k] = np.asarray(plant, dtype=np.float32) + rng.normal(0, spread, (k, 128)).astype(np.float32)
+    return x
+
+def make_event(cloud, rng, name, n, plant=None, photos_per_face=3):
+    """
+    Write a synthetic event of n faces straight into the store, with the
+    indexes its settings call for built up front (the app builds them in
+    the background), so what is measured is the configured search path.
+    """
+    x = synthetic_encodings(rng, n, plant=plant)
+    items = []
+    for i, enc in enumerate(x):
+        public_id = f"{name}/known_faces/p{i // photos_per_face:07d}"
+        items.append({"public_id": public_id, "face_index": i % photos_per_face,
+                      "url": cloud.url(public_id), "encoding": enc})
+    ashik.save_local_encodings(name, items)
+    ashik.update_clusters(name)
+    ashik.update_ann_index(name)
+    ashik.encodings_cache.invalidate(name)
+    return name
+
+def load_source_photos(directory, limit=12):
+    photos = []
+    if directory and os.path.isdir(directory):
+        for fname in sorted(os.listdir(directory)):
+            if fname.lower().endswith((".jpg", ".jpeg", ".png")):
+                try:
+                    img = ImageOps.exif_transpose(Image.open(os.path.join(directory, fname))).convert("RGB")
+                    img.thumbnail((2048, 2048))
+                    photos.append(img)
+                except Exception:
+                    continue
+            if len(photos) >= limit:
+                break
+    return photos
+
+def drawn_face(rng, size=1200):
+    """A crude generated face (for when no sample photos are available)."""
+    bg = tuple(int(v) for v in rng.integers(0, 255, 3))
+    img = Image.new("RGB", (size, int(size * 0.75)), bg)
+    d = ImageDraw.Draw(img)
+    cx, cy, r = size // 2, int(size * 0.375), int(size * 0.18)
+    skin = tuple(int(v) for v in rng.integers(150, 230, 3))
+    d.ellipse((cx - r, cy - int(r * 1.3), cx + r, cy + int(r * 1.3)), fill=skin)
+    for ex in (cx - r // 2, cx + r // 2):
+        d.ellipse((ex - r // 6, cy - r // 3 - r // 10, ex + r // 6, cy - r // 3 + r // 10), fill=(255, 255, 255))
+        d.ellipse((ex - r // 14, cy - r // 3 - r // 14, ex + r // 14, cy - r // 3 + r // 14), fill=(40, 30, 20))
+    d.line((cx, cy - r // 6, cx - r // 10, cy + r // 4), fill=(120, 80, 60), width=max(size // 200, 2))
+    d.arc((cx - r // 2, cy + r // 6, cx + r // 2, cy + r // 1.5), 20, 160, fill=(150, 40, 40), width=max(size // 150, 3))
+    return img
+
+def synthetic_photo(rng, sources):
+    """JPEG bytes of a unique photo: a jittered sample photo, or a drawn face."""
+    if sources:
+        img = sources[int(rng.integers(len(sources)))]
+        w, h = img.size
+        s = rng.uniform(0.85, 1.0)
+        left, top = int(rng.uniform(0, w * (1 - s))), int(rng.uniform(0, h * (1 - s)))
+        img = img.crop((left, top, left + int(w * s), top + int(h * s)))
+        if rng.random() < 0.5:
+            img = ImageOps.mirror(img)
+    else:
+        img = drawn_face(rng)
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+# -------------------- HELPERS --------------------
+def summarize(samples_s):
+    ms = sorted(v * 1000 for v in samples_s)
+    return {
+        "n": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p50_ms": round(ms[len(ms) // 2], 3),
+        "p95_ms": round(ms[min(int(len(ms) * 0.95), len(ms) - 1)], 3),
+        "min_ms": round(ms[0], 3),
+    }
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return time.perf_counter() - t0, out
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+# -------------------- BENCHMARKS --------------------
+def bench_load(cloud, rng, sizes, reps):
+    """Encodings load time: legacy dict list, cold matcher (disk) and cached matcher."""
+    results = []
+    for n in sizes:
+        event = make_event(cloud, rng, f"bench_load_{n}", n)
+        legacy = [timed(ashik.load_local_encodings, event)[0] for _ in range(max(reps // 5, 1))]
+        cold = []
+        for _ in range(reps):
+            ashik.encodings_cache.invalidate(event)
+            cold.append(timed(ashik.get_event_matcher, event)[0])
+        warm = [timed(ashik.get_event_matcher, event)[0] for _ in range(reps)]
+        results.append({"bench": "load", "faces": n, "load_local_encodings": summarize(legacy),
+                        "matcher_cold": summarize(cold), "matcher_cached": summarize(warm),
+                        "store_bytes": os.path.getsize(ashik.local_encoding_path(event))})
+    return results
+
+def bench_match(cloud, rng, sizes, reps):
+    """In-memory matching only, with the event's configured search path."""
+    results = []
+    for n in sizes:
+        event = make_event(cloud, rng, f"bench_match_{n}", n)
+        matcher = ashik.get_event_matcher(event)
+        s = ashik.event_settings(event)
+        queries = np.asarray(matcher.matrix[rng.integers(0, n, reps)])
+        exact = [timed(matcher.match, q, s["tolerance"], s["top_k"])[0] for q in queries]
+        configured = [timed(matcher.match, q, s["tolerance"], s["top_k"], nprobe=s["ann_nprobe"],
+                            margin=s["cluster_margin"] if s["clusters"] else None,
+                            refine=s["cluster_refine"])[0] for q in queries]
+        results.append({"bench": "match", "faces": n, "exact": summarize(exact),
+                        "configured": summarize(configured),
+                        "clusters": len(matcher.clusters.centroids) if matcher.clusters is not None else None,
+                        "ann": matcher.ann is not None})
+    return results
+
+def bench_selfie(cloud, rng, sizes, reps, selfie_bytes):
+    """upload_selfie end to end (Flask test client) against event size."""
+    client = ashik.app.test_client()
+    selfie_enc = ashik.encode_selfie(BytesIO(selfie_bytes), ashik.event_settings("bench")["selfie_profile"])
+    plant = selfie_enc[0] if selfie_enc else None
+    results = []
+    for n in sizes:
+        event = make_event(cloud, rng, f"bench_selfie_{n}", n, plant=plant)
+
+        def post():
+            r = client.post(f"/upload/{event}", data={"file": (BytesIO(selfie_bytes), "selfie.jpg")})
+            assert r.status_code == 302, r.status_code
+        first = timed(post)[0]
+        samples = [timed(post)[0] for _ in range(reps)]
+        with client.session_transaction() as sess:
+            data = ashik.result_store.get(sess.get("result_id"))
+        results.append({"bench": "upload_selfie", "faces": n, "first_request_ms": round(first * 1000, 3),
+                        "latency": summarize(samples), "matches": len(data["matches"]) if data else 0,
+                        "selfie_has_face": plant is not None})
+    return results
+
+def bench_ingest(cloud, rng, n_images, workers_list, sources):
+    """generate_encodings_for_event throughput, per encode worker (core)."""
+    photos = [synthetic_photo(rng, sources) for _ in range(n_images)]
+    results = []
+    for workers in workers_list:
+        event = f"bench_ingest_{workers}_{uuid.uuid4().hex[:6]}"
+        for i, data in enumerate(photos):
+            cloud.images[f"{event}/known_faces/img{i:05d}"] = data
+        ashik.ENCODE_WORKERS = workers
+        fetches = cloud.calls["fetch"]
+        seconds, ok = timed(ashik.generate_encodings_for_event, event)
+        faces = len(ashik.get_event_matcher(event))
+        rate = n_images / seconds if seconds else None
+        results.append({"bench": "ingest", "images": n_images, "workers": workers, "ok": ok,
+                        "seconds": round(seconds, 3), "images_per_sec": round(rate, 3) if rate else None,
+                        "images_per_sec_per_core": round(rate / workers, 3) if rate else None,
+                        "faces": faces, "fetches": cloud.calls["fetch"] - fetches})
+        # incremental re-run: nothing new, should cost no downloads
+        fetches = cloud.calls["fetch"]
+        rerun = timed(ashik.generate_encodings_for_event, event)[0]
+        results[-1]["rerun_seconds"] = round(rerun, 3)
+        results[-1]["rerun_fetches"] = cloud.calls["fetch"] - fetches
+    return results
+
+def bench_download(cloud, rng, n_images, sources):
+    """/download proxy throughput: first fetch (cache miss) and repeat (cache hit)."""
+    client = ashik.app.test_client()
+    urls = []
+    for i in range(n_images):
+        public_id = f"bench_download/known_faces/img{i:05d}"
+        cloud.images[public_id] = synthetic_photo(rng, sources)
+        urls.append(cloud.url(public_id))
+    shutil.rmtree(ashik.IMAGE_CACHE_DIR, ignore_errors=True)
+    os.makedirs(ashik.IMAGE_CACHE_DIR, exist_ok=True)
+    ashik.image_cache._bytes = None
+    results = []
+    for phase in ("miss", "hit"):
+        total_bytes = 0
+        samples = []
+        t0 = time.perf_counter()
+        for url in urls:
+            dt, r = timed(client.get, "/download", query_string={"url": url})
+            assert r.status_code == 200, r.status_code
+            total_bytes += len(r.data)
+            samples.append(dt)
+        seconds = time.perf_counter() - t0
+        results.append({"bench": "download", "phase": phase, "requests": len(urls),
+                        "requests_per_sec": round(len(urls) / seconds, 2),
+                        "mb_per_sec": round(total_bytes / seconds / 1e6, 2),
+                        "latency": summarize(samples)})
+    return results
+
+# -------------------- COMPARE --------------------
+def _key(record):
+    return tuple((k, record[k]) for k in ("bench", "faces", "images", "workers", "phase") if k in record)
+
+def _flatten(record, prefix=""):
+    out = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[f"{prefix}{k}"] = v
+    return out
+
+def compare(old_path, new_path):
+    """Print metric ratios (new / old) for records present in both runs."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_by_key = {_key(r): r for r in old["results"]}
+    print(f"# {old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    for record in new["results"]:
+        before = old_by_key.get(_key(record))
+        if before is None:
+            continue
+        a, b = _flatten(before), _flatten(record)
+        label = " ".join(f"{k}={v}" for k, v in _key(record))
+        for metric in sorted(set(a) & set(b)):
+            if a[metric] and metric.endswith(("_ms", "_sec", "seconds")):
+                print(f"{label:45s} {metric:32s} {a[metric]:>12} -> {b[metric]:>12}  x{b[metric] / a[metric]:.2f}")
+
+# -------------------- MAIN --------------------
+def main():
+    parser = argparse.ArgumentParser(description="Ashi SmartPix benchmarks")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="event sizes (faces) for load/match/selfie")
+    parser.add_argument("--reps", type=int, default=20, help="repetitions per latency measurement")
+    parser.add_argument("--ingest-images", type=int, default=40)
+    parser.add_argument("--ingest-workers", default=f"1,{os.cpu_count() or 1}")
+    parser.add_argument("--download-images", type=int, default=40)
+    parser.add_argument("--images", default=os.path.join(REPO_DIR, "uploads"),
+                        help="sample photos to generate event images from")
+    parser.add_argument("--selfie", default=os.path.join(REPO_DIR, "static", "uploads", "selfie.jpg"))
+    parser.add_argument("--only", default="load,match,selfie,ingest,download")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sizes = [int(v) for v in args.sizes.split(",") if v]
+    only = set(args.only.split(","))
+    rng = np.random.default_rng(args.seed)
+    cloud = FakeCloudinary()
+    cloud.install()
+    sources = load_source_photos(args.images)
+    with open(args.selfie, "rb") as f:
+        selfie_bytes = f.read()
+
+    results = []
+    # the app logs to stdout; keep stdout for the JSON report
+    try:
+        with redirect_stdout(sys.stderr):
+            if "load" in only:
+                results += bench_load(cloud, rng, sizes, args.reps)
+            if "match" in only:
+                results += bench_match(cloud, rng, sizes, args.reps)
+            if "selfie" in only:
+                results += bench_selfie(cloud, rng, sizes, args.reps, selfie_bytes)
+            if "ingest" in only:
+                workers = sorted({int(v) for v in args.ingest_workers.split(",") if v})
+                results += bench_ingest(cloud, rng, args.ingest_images, workers, sources)
+            if "download" in only:
+                results += bench_download(cloud, rng, args.download_images, sources)
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+            "sample_photos": len(sources),
+            "fake_cloudinary_calls": cloud.calls,
+        },
+        "results": results,
+    }
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# gunicorn.conf.py  — production serving: gunicorn -c gunicorn.conf.py ashik:app
+# The app (and dlib's models) is imported once in the master, warmed up and
+# given the PRELOAD_EVENTS encodings, then forked; workers share all of it
+# copy-on-write. Worker count comes from WEB_CONCURRENCY, the port from PORT.
+import gc
+import os
+
+# tells ashik not to start its background thread in the master
+os.environ["SMARTPIX_PRELOAD"] = "1"
+
+preload_app = True
+# threads: the selfie/upload pools and the progress stream need concurrent requests
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+def when_ready(server):
+    import ashik
+    ashik.warm_up()
+    ashik.preload_events()
+    # keep the garbage collector from touching (and so copying) the preloaded heap
+    gc.freeze()
+
+def post_fork(server, worker):
+    import ashik
+    ashik.start_background_threads()
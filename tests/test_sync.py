@@ -0,0 +1,109 @@
+# tests/test_sync.py — encodings sync against the LocalRemote stand-in
+#
+#   python -m pytest tests
+import os
+import sys
+import json
+import tempfile
+
+# Everything the app writes goes to a scratch dir; set before importing ashik
+WORKDIR = tempfile.mkdtemp(prefix="smartpix-test-")
+os.environ["ENCODINGS_DIR"] = os.path.join(WORKDIR, "encodings")
+os.environ["IMAGE_CACHE_DIR"] = os.path.join(WORKDIR, "image_cache")
+os.environ["RESULTS_DIR"] = os.path.join(WORKDIR, "results")
+os.environ["ENCODINGS_REMOTE"] = "local:" + os.path.join(WORKDIR, "remote")
+os.environ["SYNC_POLL_SECONDS"] = "86400"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+import ashik
+
+
+class StaleManifestRemote(ashik.LocalRemote):
+    """LocalRemote whose manifest reads return a fixed old copy (None: 404), like a lagging CDN edge."""
+
+    def __init__(self, root, manifest):
+        super().__init__(root)
+        self.manifest = manifest
+
+    def get(self, key, etag=None, fresh=False):
+        if key.endswith("/manifest.json"):
+            return (200, self.manifest, None) if self.manifest else (404, None, None)
+        return super().get(key, etag, fresh)
+
+
+def faces(event, start, n):
+    rng = np.random.default_rng(start)
+    rows = rng.normal(size=(n, 128)).astype(np.float32)
+    rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+    return [{"public_id": f"{event}/p{start + i}", "face_index": 0, "url": f"u{start + i}", "encoding": rows[i]}
+            for i in range(n)]
+
+
+def remote_public_ids(remote, event):
+    """public_ids across the base and delta shards the remote manifest lists."""
+    status, data, _ = remote.get(ashik.manifest_key(event))
+    assert status == 200
+    manifest = json.loads(data)
+    keys = ([manifest["base"]] if manifest["base"] else []) + [s["key"] for s in manifest["shards"]]
+    ids = []
+    for key in keys:
+        ids += [item["public_id"] for item in ashik.decode_shard(remote.get(key)[1])]
+    return manifest["version"], ids
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    remote = ashik.LocalRemote(tempfile.mkdtemp(dir=WORKDIR))
+    monkeypatch.setattr(ashik, "encodings_remote", remote)
+    return remote
+
+
+def test_stale_manifest_is_not_published_over(remote, monkeypatch):
+    event = "stale_read"
+    ashik.add_event_faces(event, faces(event, 0, 5))
+    assert ashik.publish_encodings(event) == 1
+    v1_manifest = remote.get(ashik.manifest_key(event))[1]
+    ashik.add_event_faces(event, faces(event, 5, 2))
+    assert ashik.publish_encodings(event) == 2
+    v2_shard = remote.get(ashik.shard_key(event, 2))[1]
+
+    # the CDN still serves v1 to this box, whose sync state is at v2
+    ashik.add_event_faces(event, faces(event, 7, 2))
+    monkeypatch.setattr(ashik, "encodings_remote", StaleManifestRemote(remote.root, v1_manifest))
+    assert ashik.publish_encodings(event) is None
+    assert remote.get(ashik.shard_key(event, 2))[1] == v2_shard
+    assert remote_public_ids(remote, event)[0] == 2
+
+    # once the read is fresh again the held-back faces go out as v3
+    monkeypatch.setattr(ashik, "encodings_remote", remote)
+    assert ashik.publish_encodings(event) == 3
+    version, ids = remote_public_ids(remote, event)
+    assert version == 3
+    assert sorted(ids) == sorted(item["public_id"] for item in faces(event, 0, 9))
+
+
+def test_missing_manifest_after_publish_is_not_a_fresh_base(remote, monkeypatch):
+    event = "lost_read"
+    ashik.add_event_faces(event, faces(event, 0, 3))
+    assert ashik.publish_encodings(event) == 1
+    ashik.add_event_faces(event, faces(event, 3, 1))
+    # a read that comes back 404 although this box already published v1
+    monkeypatch.setattr(ashik, "encodings_remote", StaleManifestRemote(remote.root, None))
+    assert ashik.publish_encodings(event) is None
+    assert remote_public_ids(remote, event)[0] == 1
+
+
+def test_cloudinary_errors_are_not_missing(monkeypatch):
+    class Response:
+        status_code = 401
+        headers = {}
+        content = b""
+
+    monkeypatch.setattr(ashik.HTTP, "get", lambda url, **kwargs: Response())
+    with pytest.raises(ashik.DownloadError):
+        ashik.CloudinaryRemote().get("encodings/any/manifest.json")
+    Response.status_code = 404
+    assert ashik.CloudinaryRemote().get("encodings/any/manifest.json")[0] == 404